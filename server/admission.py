@@ -0,0 +1,190 @@
+"""
+Admission control: per-route priority classes with their own concurrency
+limits and queue-time budgets.
+
+Each request is assigned a class by path. When a class is at its limit the
+request waits in that class's queue; if the expected wait is already past the
+class budget, or the budget runs out while queued, it is shed immediately with
+503 and a Retry-After header, so expensive routes (bcrypt, NASA, aggregations)
+cannot starve cheap ones.
+
+Limits are configurable per class, e.g. ADMISSION_AUTH_LIMIT=4 and
+ADMISSION_AUTH_QUEUE_SECONDS=2. ADMISSION_CONTROL=0 disables the layer.
+"""
+import os
+import json
+import math
+import time
+import asyncio
+from collections import deque
+from typing import Optional
+
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1").lower() in ("1", "true", "yes")
+
+# name -> (default concurrency limit, default queue-time budget in seconds)
+DEFAULT_CLASSES = {
+    "critical": (64, 0.5),
+    "interactive": (32, 1.0),
+    "auth": (4, 2.0),
+    "upstream": (8, 2.0),
+    "heavy": (2, 1.0),
+}
+
+# (method or None for any, path prefix, class); first match wins
+ROUTE_CLASSES = [
+    ("GET", "/api/health", "critical"),
+    ("GET", "/api/admin/metrics", "critical"),
+    ("GET", "/api/admin/profiles", "critical"),
+    ("GET", "/api/environment/upstream-status", "critical"),
+    ("POST", "/api/auth/login", "auth"),
+    ("POST", "/api/auth/register", "auth"),
+    ("POST", "/api/admin/login", "auth"),
+    ("POST", "/api/admin/register", "auth"),
+    (None, "/api/environment/", "upstream"),
+    (None, "/api/admin/", "heavy"),
+    (None, "/api/", "interactive"),
+]
+
+class PriorityClass:
+    def __init__(self, name: str, limit: int, queue_budget: float):
+        self.name = name
+        self.limit = limit
+        self.queue_budget = queue_budget
+        self.active = 0
+        self._waiters = deque()
+        # Moving average of how long admitted requests hold a slot, used to predict queue time
+        self.service_time = 0.05
+        self.counters = {"admitted": 0, "queued": 0, "admitted_after_queue": 0, "rejected_fast": 0, "rejected_timeout": 0}
+        self.queue_time_ms = {"total": 0.0, "max": 0.0}
+
+    def expected_wait(self) -> float:
+        return (len(self._waiters) + 1) / self.limit * self.service_time
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.counters["admitted"] += 1
+            return True
+
+        if self.expected_wait() > self.queue_budget:
+            self.counters["rejected_fast"] += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.counters["queued"] += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_budget)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the budget ran out
+            if not future.done():
+                self._waiters.remove(future)
+                future.cancel()
+                self.counters["rejected_timeout"] += 1
+                return False
+        except asyncio.CancelledError:
+            # Client went away while queued; pass on a slot we were already given
+            if future.done() and not future.cancelled():
+                self.release(0.0)
+            elif future in self._waiters:
+                self._waiters.remove(future)
+            raise
+
+        waited = (time.perf_counter() - started) * 1000
+        self.queue_time_ms["total"] += waited
+        self.queue_time_ms["max"] = max(self.queue_time_ms["max"], waited)
+        self.counters["admitted"] += 1
+        self.counters["admitted_after_queue"] += 1
+        return True
+
+    def release(self, held_seconds: float):
+        self.service_time = 0.9 * self.service_time + 0.1 * held_seconds
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                # Hand the slot straight to the next waiter; `active` stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.expected_wait()))
+
+    def stats(self):
+        # queue_time_ms only accumulates waits that ended in admission
+        queued = self.counters["admitted_after_queue"]
+        return {
+            "limit": self.limit,
+            "queue_budget": self.queue_budget,
+            "active": self.active,
+            "queue_depth": len(self._waiters),
+            "service_time_ms": round(self.service_time * 1000, 2),
+            "counters": dict(self.counters),
+            "queue_time_ms": {
+                "avg": round(self.queue_time_ms["total"] / queued, 2) if queued else 0.0,
+                "max": round(self.queue_time_ms["max"], 2),
+            },
+        }
+
+class AdmissionController:
+    def __init__(self, classes=DEFAULT_CLASSES, routes=ROUTE_CLASSES):
+        self.classes = {}
+        for name, (limit, budget) in classes.items():
+            prefix = f"ADMISSION_{name.upper()}"
+            self.classes[name] = PriorityClass(
+                name,
+                int(os.environ.get(f"{prefix}_LIMIT", limit)),
+                float(os.environ.get(f"{prefix}_QUEUE_SECONDS", budget)),
+            )
+        self.routes = routes
+
+    def classify(self, method: str, path: str) -> Optional[PriorityClass]:
+        for route_method, prefix, name in self.routes:
+            if (route_method is None or route_method == method) and path.startswith(prefix):
+                return self.classes[name]
+        return None
+
+    def stats(self):
+        return {"enabled": ADMISSION_CONTROL, "classes": {name: c.stats() for name, c in self.classes.items()}}
+
+admission_controller = AdmissionController()
+
+class AdmissionControlMiddleware:
+    """Pure ASGI middleware so shed requests cost no more than a header write"""
+
+    def __init__(self, app, controller: AdmissionController = admission_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        priority = self.controller.classify(scope["method"], scope["path"])
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await priority.acquire():
+            await self._reject(send, priority)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            priority.release(time.perf_counter() - started)
+
+    async def _reject(self, send, priority: PriorityClass):
+        body = json.dumps({"detail": "Server is busy, please retry shortly"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(priority.retry_after()).encode()),
+                (b"x-priority-class", priority.name.encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,150 @@
+"""
+Admin impact analytics.
+
+One $facet aggregation over user_actions yields per-action completion counts
+(joined against the eco-action catalog once per distinct action, not per
+document) and active-user counts for the last 24 h / 7 d / 30 d. Results are
+cached for ADMIN_ANALYTICS_REFRESH_SECONDS. In incremental mode each refresh
+only folds in action counts completed since the previous run; the active-user
+windows are recounted from the last 30 days every time, inside the facet, so
+no per-user rows reach the result document or this process.
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+ADMIN_ANALYTICS_REFRESH_SECONDS = float(os.environ.get("ADMIN_ANALYTICS_REFRESH_SECONDS", 300))
+ADMIN_ANALYTICS_INCREMENTAL = os.environ.get("ADMIN_ANALYTICS_INCREMENTAL", "1").lower() in ("1", "true", "yes")
+# Actions newer than this are left for the next run, so late writes (e.g. a write-behind
+# batch still in flight) are not skipped by the watermark
+ADMIN_ANALYTICS_SETTLE_SECONDS = float(os.environ.get("ADMIN_ANALYTICS_SETTLE_SECONDS", 5))
+
+ACTIVE_WINDOWS = {"last_24h": timedelta(days=1), "last_7d": timedelta(days=7), "last_30d": timedelta(days=30)}
+
+def _pipeline(cutoff: datetime, watermark=None):
+    since = {name: cutoff - span for name, span in ACTIVE_WINDOWS.items()}
+    scan_from = since["last_30d"] if watermark is None else min(watermark, since["last_30d"])
+    return [
+        # Full runs scan everything; incremental runs scan the new actions plus the last 30 days
+        {"$match": {"completed_at": {"$lte": cutoff, **({"$gt": scan_from} if watermark is not None else {})}}},
+        {"$facet": {
+            "by_action": [
+                *([{"$match": {"completed_at": {"$gt": watermark}}}] if watermark is not None else []),
+                {"$group": {"_id": "$action_id", "count": {"$sum": 1}}},
+                {
+                    "$lookup": {
+                        "from": "eco_actions",
+                        "localField": "_id",
+                        "foreignField": "id",
+                        "as": "action_info"
+                    }
+                },
+                {"$unwind": {"path": "$action_info", "preserveNullAndEmptyArrays": True}},
+                {"$project": {
+                    "count": 1,
+                    "category": "$action_info.category",
+                    "difficulty": "$action_info.difficulty",
+                    "period": "$action_info.period",
+                    "co2_saved_kg": "$action_info.co2_saved_kg"
+                }}
+            ],
+            "active_users": [
+                {"$match": {"completed_at": {"$gt": since["last_30d"]}}},
+                {"$group": {"_id": "$user_id", "last_active": {"$max": "$completed_at"}}},
+                {"$group": {
+                    "_id": None,
+                    **{
+                        name: {"$sum": {"$cond": [{"$gt": ["$last_active", start]}, 1, 0]}}
+                        for name, start in since.items()
+                    }
+                }},
+                {"$project": {"_id": 0}}
+            ]
+        }}
+    ]
+
+class AdminAnalytics:
+    def __init__(self, refresh_seconds: float = ADMIN_ANALYTICS_REFRESH_SECONDS, incremental: bool = ADMIN_ANALYTICS_INCREMENTAL):
+        self.refresh_seconds = refresh_seconds
+        self.incremental = incremental
+        self._lock = asyncio.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.actions = {}       # action_id -> {"count", "category", "difficulty", "period", "co2_saved_kg"}
+        self.active_users = {name: 0 for name in ACTIVE_WINDOWS}
+        self.watermark = None
+        self.computed_at = None
+        self.snapshot = None
+
+    def _is_fresh(self) -> bool:
+        return self.computed_at is not None and datetime.utcnow() - self.computed_at < timedelta(seconds=self.refresh_seconds)
+
+    async def get(self, db: AsyncIOMotorDatabase, force: bool = False):
+        if not force and self._is_fresh():
+            return self.snapshot
+        async with self._lock:
+            # Another request may have refreshed while we waited for the lock
+            if force or not self._is_fresh():
+                await self.refresh(db)
+        return self.snapshot
+
+    async def refresh(self, db: AsyncIOMotorDatabase):
+        if not self.incremental:
+            self._reset()
+
+        cutoff = datetime.utcnow() - timedelta(seconds=ADMIN_ANALYTICS_SETTLE_SECONDS)
+        result = await db["user_actions"].aggregate(
+            _pipeline(cutoff, self.watermark), allowDiskUse=True
+        ).to_list(1)
+        facets = result[0] if result else {"by_action": [], "active_users": []}
+
+        for row in facets["by_action"]:
+            entry = self.actions.setdefault(row["_id"], {"count": 0})
+            entry["count"] += row["count"]
+            # Catalog fields come from the latest run so edits to an action are picked up
+            for field in ("category", "difficulty", "period", "co2_saved_kg"):
+                if row.get(field) is not None:
+                    entry[field] = row[field]
+        # An empty facet means nobody was active in the last 30 days
+        counts = facets["active_users"][0] if facets["active_users"] else {}
+        self.active_users = {name: counts.get(name, 0) for name in ACTIVE_WINDOWS}
+
+        self.watermark = cutoff
+        self.computed_at = datetime.utcnow()
+        self.snapshot = self._build_snapshot(await db["users"].count_documents({}))
+
+    def _build_snapshot(self, total_users: int):
+        breakdowns = {"category": {}, "difficulty": {}, "period": {}}
+        total_actions = 0
+        total_impact = 0.0
+        for entry in self.actions.values():
+            impact = entry["count"] * float(entry.get("co2_saved_kg") or 0)
+            total_actions += entry["count"]
+            total_impact += impact
+            for field, buckets in breakdowns.items():
+                bucket = buckets.setdefault(entry.get(field) or "Unknown", {"actions": 0, "impact": 0.0})
+                bucket["actions"] += entry["count"]
+                bucket["impact"] += impact
+
+        return {
+            "total_users": total_users,
+            "total_actions": total_actions,
+            "total_impact": round(total_impact, 2),
+            **{
+                f"by_{field}": sorted(
+                    ({field: key, "actions": b["actions"], "impact": round(b["impact"], 2)} for key, b in buckets.items()),
+                    key=lambda row: row["impact"],
+                    reverse=True
+                )
+                for field, buckets in breakdowns.items()
+            },
+            "active_users": dict(self.active_users),
+            "mode": "incremental" if self.incremental else "full",
+            "watermark": self.watermark,
+            "computed_at": self.computed_at,
+        }
+
+admin_analytics = AdminAnalytics()
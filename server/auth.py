@@ -96,3 +96,12 @@ async def get_current_user_optional(
     import crud
     user = await crud.get_user(db, user_id=user_id)
     return user
+
+async def get_current_admin(current_user = Depends(get_current_user)):
+    """Dependency that only lets admin accounts through"""
+    if current_user.get("role") != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return current_user
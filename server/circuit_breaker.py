@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Trips after `failure_threshold` consecutive failed or slow calls and then
+    rejects calls until `reset_timeout` has passed. Recovery is checked by a
+    single probe call (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        latency_threshold: float = 5.0,
+        reset_timeout: float = 30.0,
+        history: int = 50,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.counters = {"success": 0, "failure": 0, "slow": 0, "rejected": 0, "probes": 0}
+        self.transitions = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def _transition(self, new_state: str, reason: str):
+        # Called with the lock held
+        if new_state == self.state:
+            return
+        self.transitions.append({"from": self.state, "to": new_state, "reason": reason, "at": time.time()})
+        print(f"Circuit '{self.name}' {self.state} -> {new_state} ({reason})")
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = time.monotonic()
+        elif new_state == CLOSED:
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def allow_request(self) -> bool:
+        """True if a regular call may go upstream; open and half-open circuits fail fast"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    def try_start_probe(self) -> bool:
+        """Claim the single recovery probe once the reset timeout has elapsed"""
+        with self._lock:
+            if self.state != OPEN or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.counters["probes"] += 1
+            self._transition(HALF_OPEN, "probing upstream")
+            return True
+
+    def resolve_probe(self, reason: str):
+        """Re-open a circuit whose probe ended without recording an outcome"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._transition(OPEN, reason)
+
+    def record_success(self, latency: float):
+        with self._lock:
+            if latency > self.latency_threshold:
+                self.counters["slow"] += 1
+                self._record_failure_locked(f"slow call ({latency:.1f}s)")
+                return
+            self.counters["success"] += 1
+            self.consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED, "probe succeeded")
+
+    def record_failure(self, reason: str = "error"):
+        with self._lock:
+            self.counters["failure"] += 1
+            self._record_failure_locked(reason)
+
+    def _record_failure_locked(self, reason: str):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self._transition(OPEN, f"probe failed: {reason}")
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._transition(OPEN, f"{self.consecutive_failures} consecutive failures, last: {reason}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "latency_threshold": self.latency_threshold,
+                "reset_timeout": self.reset_timeout,
+                "open_for": round(time.monotonic() - self.opened_at, 1) if self.opened_at is not None else None,
+                "counters": dict(self.counters),
+                "transitions": list(self.transitions),
+            }
@@ -1,7 +1,9 @@
 from motor.motor_asyncio import AsyncIOMotorDatabase
 import models, schemas
 from auth import get_password_hash, verify_password
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime
+from pymongo.errors import DuplicateKeyError
 import uuid
 
 # Helper to convert MongoDB document to Pydantic-friendly dict
@@ -10,6 +12,38 @@ def fix_id(doc):
         pass 
     return doc
 
+# Indexes
+PERIOD_BUCKET_KEY = ("user_id", "bucket", "action_id")
+# Set at startup by check_period_index; while False, completions are checked with a read before writing
+period_index_ready = False
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    # Incremental admin analytics scans user_actions by completion time
+    await db["user_actions"].create_index("completed_at")
+    # One completion per goal per period bucket. Ordered (user, bucket, action) so the same
+    # index also answers "what has this user done in the current buckets". Partial because
+    # completions recorded before buckets existed have no bucket field.
+    await db["user_actions"].create_index(
+        [("user_id", 1), ("bucket", 1), ("action_id", 1)],
+        unique=True,
+        partialFilterExpression={"bucket": {"$exists": True}},
+        name="user_period_bucket_unique"
+    )
+    # Bulk imports rely on these to reject duplicate accounts without per-row lookups
+    await db["users"].create_index("username", unique=True)
+    await db["users"].create_index("email", unique=True)
+
+async def missing_unique_indexes(db: AsyncIOMotorDatabase, collection: str, keys):
+    """Which of `keys` (tuples of field names) have no unique index on `collection`"""
+    info = await db[collection].index_information()
+    unique = {tuple(field for field, _ in spec["key"]) for spec in info.values() if spec.get("unique")}
+    return [key for key in keys if tuple(key) not in unique]
+
+async def check_period_index(db: AsyncIOMotorDatabase) -> bool:
+    global period_index_ready
+    period_index_ready = not await missing_unique_indexes(db, "user_actions", [PERIOD_BUCKET_KEY])
+    return period_index_ready
+
 # Users
 async def get_user(db: AsyncIOMotorDatabase, user_id: str):
     return await db["users"].find_one({"id": user_id})
@@ -20,9 +54,8 @@ async def get_user_by_username(db: AsyncIOMotorDatabase, username: str):
 async def get_user_by_email(db: AsyncIOMotorDatabase, email: str):
     return await db["users"].find_one({"email": email})
 
-async def create_user(db: AsyncIOMotorDatabase, user: schemas.UserRegister, role: str = "user"):
-    hashed_password = get_password_hash(user.password)
-    user_dict = {
+def build_user_document(user: schemas.UserRegister, hashed_password: str, role: str = "user"):
+    return {
         "id": models.generate_uuid(),
         "username": user.username,
         "email": user.email,
@@ -42,6 +75,11 @@ async def create_user(db: AsyncIOMotorDatabase, user: schemas.UserRegister, role
         "favorite_locations": [],
         "simulations": []
     }
+
+async def create_user(db: AsyncIOMotorDatabase, user: schemas.UserRegister, role: str = "user"):
+    # bcrypt is deliberately slow; keep it off the event loop
+    hashed_password = await run_in_threadpool(get_password_hash, user.password)
+    user_dict = build_user_document(user, hashed_password, role)
     await db["users"].insert_one(user_dict)
     return user_dict
 
@@ -49,7 +87,7 @@ async def authenticate_user(db: AsyncIOMotorDatabase, email: str, password: str)
     user = await get_user_by_email(db, email)
     if not user:
         return None
-    if not verify_password(password, user["password_hash"]):
+    if not await run_in_threadpool(verify_password, password, user["password_hash"]):
         return None
     if user.get("is_active") != 1:
         return None
@@ -65,7 +103,7 @@ async def get_admin_by_username(db: AsyncIOMotorDatabase, username: str):
 
 async def create_admin(db: AsyncIOMotorDatabase, admin: schemas.AdminLogin):
     # Admins are created using registration logic but with admin role
-    hashed_password = get_password_hash(admin.password)
+    hashed_password = await run_in_threadpool(get_password_hash, admin.password)
     admin_dict = {
         "id": models.generate_uuid(),
         "username": admin.username,
@@ -98,6 +136,12 @@ async def get_saved_simulations(db: AsyncIOMotorDatabase, user_id: str):
     user = await get_user(db, user_id)
     return user.get("simulations", []) if user else []
 
+async def get_simulations_and_settings(db: AsyncIOMotorDatabase, user_id: str):
+    user = await db["users"].find_one({"id": user_id}, {"_id": 0, "simulations": 1, "settings": 1})
+    if not user:
+        return [], None
+    return user.get("simulations", []), user.get("settings")
+
 async def create_saved_simulation(db: AsyncIOMotorDatabase, simulation: schemas.SavedSimulationCreate, user_id: str):
     sim_dict = simulation.dict()
     sim_dict["id"] = models.generate_uuid()
@@ -137,7 +181,33 @@ async def delete_favorite_location(db: AsyncIOMotorDatabase, location_id: str, u
         {"$pull": {"favorite_locations": {"id": location_id}}}
     )
 
+# Period buckets: completions of a goal are unique per user within its current day/ISO week/month (UTC)
+def period_bucket(period: str, when: datetime) -> str:
+    if period == "weekly":
+        year, week, _ = when.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == "monthly":
+        return when.strftime("%Y-%m")
+    return when.strftime("%Y-%m-%d")
+
+def current_period_buckets(when: datetime = None):
+    when = when or datetime.utcnow()
+    return {period: period_bucket(period, when) for period in ("daily", "weekly", "monthly")}
+
 # Eco Actions
+_eco_action_periods = {}
+
+async def get_eco_action_period(db: AsyncIOMotorDatabase, action_id: str):
+    """Period of a catalog action, or None if it does not exist. The catalog is small and rarely changes, so it is memoized."""
+    period = _eco_action_periods.get(action_id)
+    if period is None:
+        action = await db["eco_actions"].find_one({"id": action_id}, {"period": 1})
+        if action is None:
+            return None
+        period = action.get("period") or "daily"
+        _eco_action_periods[action_id] = period
+    return period
+
 async def get_eco_actions(db: AsyncIOMotorDatabase):
     cursor = db["eco_actions"].find({})
     return await cursor.to_list(length=100)
@@ -166,9 +236,39 @@ async def get_user_actions(db: AsyncIOMotorDatabase, user_id: str):
     cursor = db["user_actions"].aggregate(pipeline)
     return await cursor.to_list(length=100)
 
-async def create_user_action(db: AsyncIOMotorDatabase, action: schemas.UserActionCreate):
+def build_user_action(action: schemas.UserActionCreate, period: str = "daily"):
     action_dict = action.dict()
     action_dict["id"] = models.generate_uuid()
     action_dict["completed_at"] = datetime.utcnow()
-    await db["user_actions"].insert_one(action_dict)
+    action_dict["period"] = period
+    action_dict["bucket"] = period_bucket(period, action_dict["completed_at"])
+    return action_dict
+
+async def create_user_action(db: AsyncIOMotorDatabase, action: schemas.UserActionCreate, period: str = "daily"):
+    """Insert a completion; returns None if the goal was already completed in this period"""
+    action_dict = build_user_action(action, period)
+    if not period_index_ready:
+        # Without the unique index nothing else stops a repeat in the same bucket
+        if await db["user_actions"].find_one({k: action_dict[k] for k in PERIOD_BUCKET_KEY}, {"_id": 1}):
+            return None
+    try:
+        await db["user_actions"].insert_one(action_dict)
+    except DuplicateKeyError:
+        return None
     return action_dict
+
+async def get_current_period_status(db: AsyncIOMotorDatabase, user_id: str):
+    buckets = current_period_buckets()
+    cursor = db["user_actions"].find(
+        {"user_id": user_id, "bucket": {"$in": list(buckets.values()), "$exists": True}},
+        {"_id": 0, "action_id": 1, "bucket": 1}
+    )
+    period_by_bucket = {bucket: period for period, bucket in buckets.items()}
+    completed = {period: [] for period in buckets}
+    async for doc in cursor:
+        completed[period_by_bucket[doc["bucket"]]].append(doc["action_id"])
+    return {"buckets": buckets, "completed": completed}
+
+async def insert_user_actions(db: AsyncIOMotorDatabase, action_dicts: list):
+    # Unordered so one bad document does not stop the rest of the batch
+    await db["user_actions"].insert_many(action_dicts, ordered=False)
@@ -3,6 +3,7 @@ import certifi
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel
 from typing import Optional
+import profiling
 
 # MongoDB Connection URL
 # Use MONGODB_URL from environment or default to local mongodb
@@ -11,9 +12,11 @@ DATABASE_NAME = os.environ.get("DATABASE_NAME") or "aerosense"
 
 # MongoDB Client
 # Add certifi to fix SSL handshake issues with Atlas
+# The profiling listener is only attached when profiling is configured
 client = AsyncIOMotorClient(
     MONGODB_URL, 
-    tlsCAFile=certifi.where()
+    tlsCAFile=certifi.where(),
+    event_listeners=[profiling.MongoSpanListener()] if profiling.PROFILING_ENABLED else []
 )
 db = client[DATABASE_NAME]
 
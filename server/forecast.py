@@ -0,0 +1,267 @@
+"""
+Short-range ensemble forecasts from the NASA POWER hourly record.
+
+Each parameter is modelled as an hour-of-day climatology (from the last
+FORECAST_HISTORY_DAYS) plus an AR(1) anomaly fitted to the same window.
+Ensemble members perturb the anomaly with the fitted residual noise; all
+members, hours and parameters are simulated together as numpy arrays and
+summarised as percentile bands. Many locations are computed in a process
+pool, and results are cached per grid cell.
+"""
+import os
+import time
+import zlib
+import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import nasa_api
+
+FORECAST_HISTORY_DAYS = int(os.environ.get("FORECAST_HISTORY_DAYS", 14))
+FORECAST_MEMBERS = int(os.environ.get("FORECAST_MEMBERS", 100))
+FORECAST_CACHE_SECONDS = float(os.environ.get("FORECAST_CACHE_SECONDS", 3600))
+# Every server worker process gets its own pool, so keep the default small
+FORECAST_WORKERS = int(os.environ.get("FORECAST_WORKERS", 2))
+MIN_HORIZON_HOURS = 24
+MAX_HORIZON_HOURS = 72
+# POWER lags real time by a few days; the model has to step across that gap before the horizon starts
+MAX_GAP_HOURS = 24 * 10
+
+# POWER parameter -> response field, with physical bounds for clipping members
+PARAMETERS = {
+    "T2M": ("temperature", -90.0, 60.0),
+    "RH2M": ("humidity", 0.0, 100.0),
+    "ALLSKY_SFC_SW_DWN": ("solar_irradiance", 0.0, 1400.0),
+}
+PERCENTILES = (10, 50, 90)
+
+class ForecastUnavailable(Exception):
+    pass
+
+def ensemble_forecast(hours: np.ndarray, values: np.ndarray, steps: int, members: int, seed: int):
+    """
+    Project `values` (time x parameter, NaN where missing) `steps` hours past
+    the last row. Returns percentile bands shaped (percentile, step, parameter)
+    and the matching AQI bands shaped (percentile, step). Pure numpy, so it can
+    run in a worker process.
+    """
+    n_params = values.shape[1]
+    hour_of_day = hours % 24
+    valid = ~np.isnan(values)
+
+    sums = np.zeros((24, n_params))
+    counts = np.zeros((24, n_params))
+    np.add.at(sums, hour_of_day, np.where(valid, values, 0.0))
+    np.add.at(counts, hour_of_day, valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        climatology = sums / counts
+    climatology = np.where(np.isnan(climatology), np.nanmean(values, axis=0), climatology)
+
+    anomaly = values - climatology[hour_of_day]
+    prev, curr = anomaly[:-1], anomaly[1:]
+    pair_ok = ~np.isnan(prev) & ~np.isnan(curr)
+    prev0, curr0 = np.where(pair_ok, prev, 0.0), np.where(pair_ok, curr, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        phi = (prev0 * curr0).sum(axis=0) / (prev0 * prev0).sum(axis=0)
+    phi = np.clip(np.nan_to_num(phi), 0.0, 0.99)
+    residual = np.where(pair_ok, curr0 - phi * prev0, np.nan)
+    sigma = np.nan_to_num(np.nanstd(residual, axis=0))
+
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal((steps, members, n_params)) * sigma
+    state = np.broadcast_to(np.nan_to_num(anomaly[-1]), (members, n_params)).copy()
+    trajectory = np.empty((steps, members, n_params))
+    for k in range(steps):
+        state = phi * state + noise[k]
+        trajectory[k] = state
+
+    future_hours = hours[-1] + 1 + np.arange(steps)
+    base = climatology[future_hours % 24]
+    projected = base[:, None, :] + trajectory
+    lower = np.array([bounds[1] for bounds in PARAMETERS.values()])
+    upper = np.array([bounds[2] for bounds in PARAMETERS.values()])
+    projected = np.clip(projected, lower, upper)
+    # No sunlight at hours that are dark in the climatology, whatever the anomaly says
+    sw = list(PARAMETERS).index("ALLSKY_SFC_SW_DWN")
+    projected[..., sw] = np.where(base[:, None, sw] < 1.0, 0.0, projected[..., sw])
+
+    t = list(PARAMETERS).index("T2M")
+    rh = list(PARAMETERS).index("RH2M")
+    aqi = nasa_api.estimate_aqi(projected[..., t], projected[..., rh], projected[..., sw])
+
+    return (
+        future_hours,
+        np.percentile(projected, PERCENTILES, axis=1),
+        np.percentile(aqi, PERCENTILES, axis=1),
+    )
+
+def _fetch_history(lat: float, lon: float):
+    end = datetime.datetime.utcnow().date()
+    start = end - datetime.timedelta(days=FORECAST_HISTORY_DAYS)
+    parameter_data = nasa_api.call_upstream(
+        nasa_api.fetch_hourly_series, lat, lon, start, end,
+        parameters=tuple(PARAMETERS), time_standard="UTC"
+    )
+    if not parameter_data:
+        raise ForecastUnavailable("NASA POWER returned no data")
+    hours, columns = nasa_api.hourly_columns(parameter_data, tuple(PARAMETERS))
+    values = np.stack([columns[p] for p in PARAMETERS], axis=1).astype(np.float64)
+
+    # Trailing hours POWER has not filled in yet are dropped; the forecast starts after the last observation
+    observed = np.flatnonzero(~np.isnan(values).any(axis=1))
+    if len(observed) < 48:
+        raise ForecastUnavailable("Not enough recent observations to forecast")
+    last = observed[-1]
+    return hours[:last + 1], values[:last + 1]
+
+def _plan(hours: np.ndarray, horizon: int):
+    """Steps to simulate and how many leading steps fall before the current hour"""
+    now_hour = int(time.time() // 3600)
+    gap = min(max(now_hour - int(hours[-1]) - 1, 0), MAX_GAP_HOURS)
+    return gap + horizon, gap
+
+def _format(lat: float, lon: float, horizon: int, gap: int, result):
+    future_hours, bands, aqi_bands = result
+    keep = slice(gap, gap + horizon)
+    series = {}
+    for i, (field, _, _) in enumerate(PARAMETERS.values()):
+        series[field] = {f"p{p}": np.round(bands[j, keep, i], 2).tolist() for j, p in enumerate(PERCENTILES)}
+    series["aqi"] = {f"p{p}": np.rint(aqi_bands[j, keep]).astype(int).tolist() for j, p in enumerate(PERCENTILES)}
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "cell": nasa_api.environment_index.cell_key(lat, lon),
+        "members": FORECAST_MEMBERS,
+        "horizon_hours": horizon,
+        "hours": [str(np.datetime64(int(h), "h")) + ":00Z" for h in future_hours[keep]],
+        "series": series,
+        "generated_at": datetime.datetime.utcnow(),
+    }
+
+class ForecastCache:
+    def __init__(self, ttl: float = FORECAST_CACHE_SECONDS, max_size: int = 5000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                cutoff = time.time() - self.ttl
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > cutoff}
+                if len(self._entries) >= self.max_size:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.time(), value)
+
+forecast_cache = ForecastCache()
+_process_pool = None
+_pool_lock = threading.Lock()
+
+def _get_process_pool():
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            # Don't fork the multi-threaded server process; start workers from a clean interpreter
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _process_pool = ProcessPoolExecutor(
+                max_workers=FORECAST_WORKERS, mp_context=multiprocessing.get_context(method)
+            )
+        return _process_pool
+
+def _discard_broken_pool(pool):
+    # A worker died; the next batch starts a fresh pool
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False)
+
+def _cache_key(lat: float, lon: float, horizon: int):
+    return (nasa_api.environment_index.cell_key(lat, lon), horizon)
+
+def _seed(lat: float, lon: float, last_hour: int) -> int:
+    # Same cell and same latest observation -> same ensemble
+    return zlib.crc32(f"{nasa_api.environment_index.cell_key(lat, lon)}:{last_hour}".encode())
+
+def get_forecast(lat: float, lon: float, horizon: int = 48):
+    key = _cache_key(lat, lon, horizon)
+    cached = forecast_cache.get(key)
+    if cached is not None:
+        return cached
+
+    hours, values = _fetch_history(lat, lon)
+    steps, gap = _plan(hours, horizon)
+    # A single location is cheaper to compute in-process than to ship to the pool
+    result = ensemble_forecast(hours, values, steps, FORECAST_MEMBERS, _seed(lat, lon, int(hours[-1])))
+    forecast = _format(lat, lon, horizon, gap, result)
+    forecast_cache.put(key, forecast)
+    return forecast
+
+def get_forecasts(locations, horizon: int = 48):
+    """
+    Forecast many (lat, lon) pairs: cached cells are answered directly, histories
+    for the rest are downloaded concurrently and the ensembles run in the process pool.
+    """
+    results = [None] * len(locations)
+    todo = {}
+    for i, (lat, lon) in enumerate(locations):
+        key = _cache_key(lat, lon, horizon)
+        cached = forecast_cache.get(key)
+        if cached is not None:
+            results[i] = cached
+        else:
+            # Locations in the same cell share one computation
+            todo.setdefault(key, []).append(i)
+    if not todo:
+        return results
+
+    keys = list(todo)
+    first = [locations[todo[k][0]] for k in keys]
+
+    def fetch(location):
+        try:
+            return _fetch_history(*location)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=min(8, len(first))) as io_pool:
+        histories = list(io_pool.map(fetch, first))
+
+    jobs = {}
+    pool = _get_process_pool()
+    for key, (lat, lon), history in zip(keys, first, histories):
+        if isinstance(history, Exception):
+            for i in todo[key]:
+                results[i] = {"latitude": locations[i][0], "longitude": locations[i][1], "error": str(history)}
+            continue
+        hours, values = history
+        steps, gap = _plan(hours, horizon)
+        future = pool.submit(ensemble_forecast, hours, values, steps, FORECAST_MEMBERS, _seed(lat, lon, int(hours[-1])))
+        jobs[key] = (future, gap)
+
+    for key, (future, gap) in jobs.items():
+        lat, lon = locations[todo[key][0]]
+        try:
+            forecast = _format(lat, lon, horizon, gap, future.result())
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                _discard_broken_pool(pool)
+            for i in todo[key]:
+                results[i] = {"latitude": locations[i][0], "longitude": locations[i][1], "error": f"Forecast failed: {e}"}
+            continue
+        forecast_cache.put(key, forecast)
+        for i in todo[key]:
+            results[i] = forecast
+    return results
@@ -1,17 +1,34 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
-from datetime import timedelta
+from typing import List, Optional, Union
+from datetime import timedelta, date
 import crud, models, schemas
 from database import get_db
 import nasa_api
-from auth import create_access_token, verify_password, get_current_user, get_current_user_optional, ACCESS_TOKEN_EXPIRE_MINUTES
+import power_archive
+import tiles
+import forecast
+from admission import ADMISSION_CONTROL, AdmissionControlMiddleware, admission_controller
+import profiling
+import user_import
+import simulation_eval
+import write_behind
+from analytics import admin_analytics
+from auth import create_access_token, verify_password, get_current_user, get_current_user_optional, get_current_admin, ACCESS_TOKEN_EXPIRE_MINUTES
 
 from contextlib import asynccontextmanager
 
+async def _flush_user_actions(action_dicts):
+    db = await get_db()
+    await crud.insert_user_actions(db, action_dicts)
+
+user_action_queue = write_behind.WriteBehindQueue(_flush_user_actions)
+
 # No table creation needed for MongoDB, but you could initialize indexes here
 
 @asynccontextmanager
@@ -19,6 +36,17 @@ async def lifespan(app: FastAPI):
     # Startup logic
     from database import get_db
     db = await get_db()
+
+    try:
+        await crud.ensure_indexes(db)
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+    try:
+        if not await crud.check_period_index(db):
+            print("WARNING: unique index on user_actions (user_id, bucket, action_id) is missing; "
+                  "eco-action completions fall back to a read-before-write check")
+    except Exception as e:
+        print(f"Error checking user_actions indexes: {e}")
     
     # 1. Create default admin in users collection
     try:
@@ -65,11 +93,27 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Error seeding eco-actions: {e}")
     
+    if write_behind.USER_ACTION_WRITE_BEHIND:
+        user_action_queue.start()
+        print(f"User action write-behind enabled (durability: {user_action_queue.durability})")
+
     yield
-    # Shutdown logic (if any) could go here
+
+    # Shutdown: flush any queued action completions before the process exits
+    if user_action_queue.running:
+        await user_action_queue.drain()
+        print(f"Drained user action queue: {user_action_queue.counters['written']} written")
 
 app = FastAPI(lifespan=lifespan)
 
+# Opt-in request profiling; innermost so queueing in admission control is not counted
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+
+# Per-route concurrency limits and load shedding; added before CORS so shed responses still carry CORS headers
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
 # CORS configuration
 # In production, allow all for simpler deployment, or add specific Vercel/Render domains
 if os.environ.get("VERCEL") or os.environ.get("RENDER") or os.environ.get("NODE_ENV") == "production":
@@ -160,7 +204,8 @@ async def login(user_credentials: schemas.UserLogin, db = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    if not verify_password(user_credentials.password, user['password_hash']):
+    # bcrypt runs on the thread pool so admitted logins don't block the event loop
+    if not await run_in_threadpool(verify_password, user_credentials.password, user['password_hash']):
         print(f"Login failed: Incorrect password for {user_credentials.email}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -202,9 +247,14 @@ async def read_current_user(current_user = Depends(get_current_user)):
 @app.post("/api/admin/login")
 async def admin_login(admin: schemas.AdminLogin, db = Depends(get_db)):
     db_admin = await crud.get_admin_by_username(db, username=admin.username)
-    if not db_admin or not verify_password(admin.password, db_admin['password_hash']):
+    if not db_admin or not await run_in_threadpool(verify_password, admin.password, db_admin['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
-    return {"status": "success", "admin_id": db_admin['id'], "username": db_admin['username']}
+    # Bearer token for admin-only endpoints such as bulk user import/export
+    access_token = create_access_token(
+        data={"sub": str(db_admin['id'])},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {"status": "success", "admin_id": db_admin['id'], "username": db_admin['username'], "access_token": access_token}
 
 @app.post("/api/admin/register")
 async def register_admin(admin: schemas.AdminLogin, db = Depends(get_db)):
@@ -246,6 +296,71 @@ async def get_admin_stats(db = Depends(get_db)):
         "total_impact": round(float(total_impact), 2)
     }
 
+@app.post("/api/admin/users/import")
+async def import_users(
+    request: Request,
+    format: Optional[str] = None,
+    admin = Depends(get_current_admin),
+    db = Depends(get_db)
+):
+    """Bulk-register users from a streamed CSV or NDJSON body; returns a per-row report"""
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    # Duplicates are only caught by the unique indexes; if building them failed at startup
+    # (e.g. existing duplicate emails), importing would silently create duplicate accounts
+    missing = await crud.missing_unique_indexes(db, "users", [("username",), ("email",)])
+    if missing:
+        raise HTTPException(
+            status_code=503,
+            detail=f"User import unavailable: no unique index on {', '.join(k[0] for k in missing)}"
+        )
+    report = await user_import.import_users(db, request.stream(), fmt)
+    print(f"Admin {admin['username']} imported {report['created']}/{report['total_rows']} users ({report['rows_per_second']} rows/s)")
+    return report
+
+@app.get("/api/admin/users/export")
+async def export_users(
+    format: str = "ndjson",
+    admin = Depends(get_current_admin),
+    db = Depends(get_db)
+):
+    """Stream all users as CSV or NDJSON (password hashes excluded)"""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        user_import.export_users(db, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=users.{format}"}
+    )
+
+@app.get("/api/admin/analytics", dependencies=[Depends(get_current_admin)])
+async def get_admin_analytics(refresh: bool = False, db = Depends(get_db)):
+    """Impact by category, difficulty and period plus active-user counts (cached)"""
+    return await admin_analytics.get(db, force=refresh)
+
+@app.get("/api/admin/metrics", dependencies=[Depends(get_current_admin)])
+async def get_admin_metrics():
+    """Internal queue and cache metrics"""
+    return {
+        "admission": admission_controller.stats(),
+        "user_action_queue": user_action_queue.stats(),
+        "tile_cache": tiles.tile_cache.stats()
+    }
+
+@app.get("/api/admin/profiles", dependencies=[Depends(get_current_admin)])
+async def list_profiles():
+    """Recently captured request profiles, newest first"""
+    return {"enabled": profiling.PROFILING_ENABLED, "profiles": profiling.profile_store.list()}
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(get_current_admin)])
+async def read_profile(profile_id: str):
+    profile = profiling.profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.to_dict()
+
 # ============ USER SETTINGS ROUTES (PROTECTED) ============
 
 @app.get("/api/user-settings/{user_id}", response_model=schemas.UserSettings)
@@ -289,6 +404,24 @@ async def read_simulations(
     """Get current user's saved simulations"""
     return await crud.get_saved_simulations(db, user_id=current_user['id'])
 
+@app.get("/api/simulations/evaluate", response_model=schemas.SimulationEvaluation)
+async def evaluate_simulations(
+    current_user = Depends(get_current_user),
+    db = Depends(get_db)
+):
+    """Score every saved simulation against live conditions at the user's location"""
+    simulations, settings = await crud.get_simulations_and_settings(db, user_id=current_user['id'])
+    settings = schemas.UserSettings(**(settings or {}))
+    # One upstream lookup for the whole batch; get_live_data blocks, so keep it off the event loop
+    conditions = await run_in_threadpool(nasa_api.get_live_data, lat=settings.latitude, lon=settings.longitude)
+    return {
+        "city": settings.selected_city,
+        "latitude": settings.latitude,
+        "longitude": settings.longitude,
+        "conditions": conditions,
+        "results": simulation_eval.evaluate(simulations, conditions)
+    }
+
 @app.post("/api/simulations", response_model=schemas.SavedSimulation)
 async def create_simulation(
     simulation: schemas.SavedSimulationCreate,
@@ -342,6 +475,82 @@ async def delete_location(
 def get_current_environment(latitude: float, longitude: float):
     return nasa_api.get_live_data(lat=latitude, lon=longitude)
 
+@app.get("/api/environment/upstream-status")
+def get_upstream_status():
+    """Circuit breaker state and recent transitions for the NASA POWER upstream"""
+    return {
+        "nasa_power": nasa_api.upstream_breaker.stats(),
+        "cached_cells": len(nasa_api.environment_index),
+        "shared_cache": nasa_api.shared_cache.stats() if nasa_api.shared_cache is not None else None
+    }
+
+@app.get("/api/environment/history")
+def get_environment_history(
+    latitude: float,
+    longitude: float,
+    start: date,
+    end: date,
+    agg: str = "daily",
+    compare_years: int = 0
+):
+    """Aggregate archived NASA POWER hours for a date range, optionally alongside the same range in past years"""
+    if agg not in power_archive.AGGREGATIONS:
+        raise HTTPException(status_code=400, detail=f"agg must be one of {', '.join(power_archive.AGGREGATIONS)}")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if agg == "hourly" and ((end - start).days + 1) * 24 > power_archive.HISTORY_MAX_HOURLY_HOURS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"agg=hourly is limited to {power_archive.HISTORY_MAX_HOURLY_HOURS} hours; use a coarser aggregation"
+        )
+    if not 0 <= compare_years <= 20:
+        raise HTTPException(status_code=400, detail="compare_years must be between 0 and 20")
+
+    history = power_archive.query_history_with_past_years(
+        latitude, longitude, start, end, agg=agg, compare_years=compare_years
+    )
+    if history is None:
+        raise HTTPException(status_code=404, detail="No archived data for this location")
+    # Already plain JSON types; skip jsonable_encoder's per-element walk over long columns
+    return JSONResponse(history)
+
+def _check_forecast_hours(hours: int):
+    if not forecast.MIN_HORIZON_HOURS <= hours <= forecast.MAX_HORIZON_HOURS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"hours must be between {forecast.MIN_HORIZON_HOURS} and {forecast.MAX_HORIZON_HOURS}"
+        )
+
+@app.get("/api/environment/forecast")
+def get_environment_forecast(latitude: float, longitude: float, hours: int = 48):
+    """Ensemble forecast bands (p10/p50/p90) for temperature, humidity, irradiance and AQI"""
+    _check_forecast_hours(hours)
+    try:
+        return forecast.get_forecast(latitude, longitude, horizon=hours)
+    except (forecast.ForecastUnavailable, nasa_api.UpstreamUnavailable) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        print(f"Forecast error: {e}")
+        raise HTTPException(status_code=503, detail="Forecast temporarily unavailable")
+
+@app.post("/api/environment/forecast/batch")
+def get_environment_forecasts(request: schemas.ForecastBatchRequest):
+    """Forecasts for many locations at once (e.g. all favorite locations)"""
+    _check_forecast_hours(request.hours)
+    if len(request.locations) > 100:
+        raise HTTPException(status_code=400, detail="At most 100 locations per request")
+    return forecast.get_forecasts(
+        [(loc.latitude, loc.longitude) for loc in request.locations],
+        horizon=request.hours
+    )
+
+@app.get("/api/environment/tiles/{z}/{x}/{y}")
+def get_environment_tile(z: int, x: int, y: int):
+    """AQI/temperature/UV/irradiance raster for one Web Mercator map tile"""
+    if not 0 <= z <= tiles.MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+    return tiles.get_tile(z, x, y)
+
 # Eco Actions Routes
 @app.get("/api/eco-actions", response_model=List[schemas.EcoAction])
 async def read_eco_actions(db = Depends(get_db)):
@@ -359,30 +568,46 @@ async def log_user_action(
     if not action_id:
         raise HTTPException(status_code=400, detail="action_id is required")
         
-    # Check if already completed
-    existing = await db["user_actions"].find_one({
-        "action_id": action_id,
-        "user_id": current_user['id']
-    })
-    
-    if existing:
-         return {"status": "already_done", "message": "You've already completed this action!"}
+    period = await crud.get_eco_action_period(db, action_id)
+    if period is None:
+        raise HTTPException(status_code=404, detail="Eco-action not found")
 
     user_action = schemas.UserActionCreate(
         user_id=current_user['id'],
         action_id=action_id
     )
-    
-    await crud.create_user_action(db, user_action)
+    already_done = {"status": "already_done", "message": f"You've already completed this {period} goal!"}
+
+    # Repeats within the same period are rejected by the unique (user_id, bucket, action_id) index,
+    # so there is no read-before-write. If that index is missing, batched writes could not reject
+    # repeats, so completions go through create_user_action's fallback check instead.
+    if user_action_queue.running and crud.period_index_ready:
+        action_dict = crud.build_user_action(user_action, period)
+        key = (current_user['id'], action_dict["bucket"], action_id)
+        if user_action_queue.is_pending(key):
+            return already_done
+        try:
+            written = await user_action_queue.put(action_dict, key=key)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error recording action: {str(e)}")
+        if written is False:
+            return already_done
+    elif await crud.create_user_action(db, user_action, period) is None:
+        return already_done
     print(f"User {current_user['username']} completed action {action_id}")
     return {"status": "success", "message": "Great job! Your action has been recorded."}
 
-@app.get("/api/eco-actions/history", response_model=List[schemas.UserAction])
+@app.get("/api/eco-actions/history", response_model=Union[List[schemas.UserAction], schemas.PeriodStatus])
 async def read_user_actions(
+    period_status: Optional[str] = Query(None, alias="status"),
     current_user = Depends(get_current_user),
     db = Depends(get_db)
 ):
-    """Get current user's eco-action history (protected)"""
+    """Get current user's eco-action history, or with ?status=current which goals are done this period (protected)"""
+    if period_status == "current":
+        return await crud.get_current_period_status(db, user_id=current_user['id'])
+    if period_status is not None:
+        raise HTTPException(status_code=400, detail="status must be 'current'")
     return await crud.get_user_actions(db, user_id=current_user['id'])
 
 
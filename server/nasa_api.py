@@ -1,78 +1,268 @@
+import os
+import time
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import random
+import numpy as np
+from spatial_index import SpatialIndex
+from circuit_breaker import CircuitBreaker
+from shared_cache import shared_cache
+import profiling
 
 NASA_POWER_API_URL = "https://power.larc.nasa.gov/api/temporal/hourly/point"
+HOURLY_PARAMETERS = ("T2M", "RH2M", "ALLSKY_SFC_SW_DWN", "ALLSKY_SFC_UV_INDEX")
+MISSING_VALUE = -999
+
+# Nearby requests are answered from readings we already fetched instead of a new upstream call.
+# ENV_CACHE_MODE is "nearest" (closest cell within the radius) or "idw" (inverse-distance blend).
+ENV_CACHE_RADIUS_KM = float(os.environ.get("ENV_CACHE_RADIUS_KM", 5))
+ENV_CACHE_TTL_SECONDS = float(os.environ.get("ENV_CACHE_TTL_SECONDS", 1800))
+ENV_CACHE_MODE = os.environ.get("ENV_CACHE_MODE", "nearest")
+ENV_CACHE_NEIGHBORS = int(os.environ.get("ENV_CACHE_NEIGHBORS", 4))
+# Expired readings younger than this are served (flagged stale) while a background refresh runs
+ENV_CACHE_STALE_SECONDS = float(os.environ.get("ENV_CACHE_STALE_SECONDS", 6 * 3600))
+
+environment_index = SpatialIndex()
+
+upstream_breaker = CircuitBreaker(
+    "nasa_power",
+    failure_threshold=int(os.environ.get("NASA_BREAKER_FAILURES", 3)),
+    latency_threshold=float(os.environ.get("NASA_BREAKER_LATENCY_SECONDS", 5)),
+    reset_timeout=float(os.environ.get("NASA_BREAKER_RESET_SECONDS", 30)),
+)
+
+# Calls slower than the breaker's latency threshold count as failures anyway, so don't wait much longer
+NASA_LIVE_TIMEOUT_SECONDS = float(os.environ.get("NASA_LIVE_TIMEOUT_SECONDS", upstream_breaker.latency_threshold))
+
+# Background refreshes and probes share a small pool; refreshes beyond the backlog cap are skipped
+# (the caller already has a stale value, and a later request will ask again)
+NASA_REFRESH_WORKERS = int(os.environ.get("NASA_REFRESH_WORKERS", 4))
+NASA_REFRESH_BACKLOG = int(os.environ.get("NASA_REFRESH_BACKLOG", 64))
+_refresh_pool = ThreadPoolExecutor(max_workers=NASA_REFRESH_WORKERS, thread_name_prefix="nasa-refresh")
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+FALLBACK_DATA = {
+    "temperature": 28,
+    "humidity": 60,
+    "solar_irradiance": 500,
+    "uv_index": 5,
+    "aqi": 75
+}
+
+def estimate_aqi(temperature, humidity, solar_irradiance):
+    """
+    Deterministic AQI proxy from meteorology, usable on scalars or numpy arrays.
+    Sunlight and heat drive ground-level ozone formation; high humidity favours
+    secondary aerosol haze.
+    """
+    ozone = 0.05 * solar_irradiance * (1 + np.maximum(temperature - 20, 0) / 15)
+    haze = 0.25 * np.maximum(humidity - 50, 0)
+    return np.clip(np.rint(30 + ozone + haze), 10, 300)
+
+def get_cached_data(lat: float, lon: float):
+    """Answer from the spatial cache, or None if no fresh cell is close enough"""
+    if ENV_CACHE_MODE == "idw":
+        return environment_index.interpolate(
+            lat, lon, ENV_CACHE_RADIUS_KM, k=ENV_CACHE_NEIGHBORS, max_age=ENV_CACHE_TTL_SECONDS
+        )
+    hit = environment_index.nearest(lat, lon, ENV_CACHE_RADIUS_KM, max_age=ENV_CACHE_TTL_SECONDS)
+    return dict(hit[1]["value"]) if hit else None
+
+def _last_known_good(lat: float, lon: float, max_age=None):
+    hit = environment_index.nearest(lat, lon, ENV_CACHE_RADIUS_KM, max_age=max_age)
+    if hit is None:
+        return None
+    value = dict(hit[1]["value"])
+    value["stale"] = True
+    return value
+
+def _fallback_data():
+    return dict(FALLBACK_DATA, stale=True)
+
+class UpstreamUnavailable(Exception):
+    pass
+
+def _timed_upstream(fn, *args, **kwargs):
+    # Feeds the outcome and latency of an upstream call into the breaker
+    started = time.monotonic()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        upstream_breaker.record_failure(str(e))
+        raise
+    upstream_breaker.record_success(time.monotonic() - started)
+    return result
+
+def call_upstream(fn, *args, **kwargs):
+    """Run an upstream call through the circuit breaker, failing fast while it is open"""
+    if not upstream_breaker.allow_request():
+        raise UpstreamUnavailable("NASA POWER circuit is open")
+    return _timed_upstream(fn, *args, **kwargs)
+
+def _fetch_upstream(lat: float, lon: float):
+    return _timed_upstream(fetch_live_data, lat, lon)
+
+def _fetch_and_store(lat: float, lon: float):
+    if shared_cache is not None:
+        # One worker on the host fetches each cell; the others pick up its published result
+        data, fetched_at = shared_cache.get_or_fetch(
+            f"env:{environment_index.cell_key(lat, lon)}",
+            lambda: _fetch_upstream(lat, lon),
+            ttl=ENV_CACHE_STALE_SECONDS,
+            max_age=ENV_CACHE_TTL_SECONDS,
+        )
+    else:
+        data, fetched_at = _fetch_upstream(lat, lon), None
+    environment_index.insert(lat, lon, data, fetched_at=fetched_at)
+    return data
+
+def _run_in_background(fn, lat: float, lon: float, label: str):
+    def run():
+        try:
+            fn(lat, lon)
+        except Exception as e:
+            print(f"NASA {label} failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard((round(lat, 2), round(lon, 2)))
+    _refresh_pool.submit(run)
+
+def _refresh_in_background(lat: float, lon: float):
+    # At most one refresh per ~1 km cell at a time
+    key = (round(lat, 2), round(lon, 2))
+    with _refreshing_lock:
+        if key in _refreshing or len(_refreshing) >= NASA_REFRESH_BACKLOG:
+            return
+        _refreshing.add(key)
+    _run_in_background(_fetch_and_store, lat, lon, "background refresh")
+
+def _probe(lat: float, lon: float):
+    # The probe must reach the upstream itself: an answer from the shared cache
+    # says nothing about upstream health and would leave the breaker half-open
+    try:
+        data = _fetch_upstream(lat, lon)
+        environment_index.insert(lat, lon, data)
+        if shared_cache is not None:
+            try:
+                shared_cache.set(f"env:{environment_index.cell_key(lat, lon)}", data, ttl=ENV_CACHE_STALE_SECONDS)
+            except Exception as e:
+                print(f"Could not publish probe result to shared cache: {e}")
+    finally:
+        upstream_breaker.resolve_probe("probe did not complete")
+
+def _start_probe(lat: float, lon: float):
+    # The breaker hands out a single probe per reset window
+    if upstream_breaker.try_start_probe():
+        _run_in_background(_probe, lat, lon, "recovery probe")
 
 def get_live_data(lat: float, lon: float):
-    # NASA Power API is not truly "live" (usually some delay), but we can query for the "latest available"
-    # Or for a specific recent range.
-    # For "Hourly" data, it provides typically up to a few days ago or sometimes near real-time depending on the product.
-    # We will request the last 2 days to ensure we get *some* data points.
-    
-    end_date = datetime.date.today()
-    start_date = end_date - datetime.timedelta(days=7) # Get last 7 days to ensure data availability
-    
-    start_str = start_str = start_date.strftime("%Y%m%d")
-    end_str = end_date.strftime("%Y%m%d")
+    cached = get_cached_data(lat, lon)
+    if cached is not None:
+        return cached
+
+    if not upstream_breaker.allow_request():
+        # Fail fast while the upstream is unhealthy instead of tying up a worker for the full timeout
+        _start_probe(lat, lon)
+        return _last_known_good(lat, lon) or _fallback_data()
+
+    stale = _last_known_good(lat, lon, max_age=ENV_CACHE_STALE_SECONDS)
+    if stale is not None:
+        _refresh_in_background(lat, lon)
+        return stale
+
+    try:
+        return dict(_fetch_and_store(lat, lon))
+    except Exception as e:
+        print(f"Error fetching NASA data: {e}")
+        return _last_known_good(lat, lon) or _fallback_data()
 
+def fetch_hourly_series(lat: float, lon: float, start_date: datetime.date, end_date: datetime.date,
+                        parameters=HOURLY_PARAMETERS, timeout: float = 10, time_standard: str = None):
+    """Download raw hourly POWER values as {param: {"YYYYMMDDHH": value}} (-999 marks missing)"""
     params = {
-        "parameters": "T2M,RH2M,ALLSKY_SFC_SW_DWN,ALLSKY_SFC_UV_INDEX",
+        "parameters": ",".join(parameters),
         "community": "RE",
         "longitude": lon,
         "latitude": lat,
-        "start": start_str,
-        "end": end_str,
+        "start": start_date.strftime("%Y%m%d"),
+        "end": end_date.strftime("%Y%m%d"),
         "format": "JSON"
     }
+    if time_standard:
+        # POWER defaults to local solar time; "UTC" aligns hours with wall-clock time
+        params["time-standard"] = time_standard
 
-    try:
-        response = requests.get(NASA_POWER_API_URL, params=params, timeout=10)
+    with profiling.span("nasa", "hourly/point", days=(end_date - start_date).days + 1):
+        response = requests.get(NASA_POWER_API_URL, params=params, timeout=timeout)
         response.raise_for_status()
         data = response.json()
+    return data.get("properties", {}).get("parameter", {})
+
+def hourly_columns(parameter_data: dict, parameters=HOURLY_PARAMETERS):
+    """
+    Turn POWER's {param: {"YYYYMMDDHH": value}} payload into an int64 array of
+    hours since the Unix epoch and aligned float32 columns (NaN where missing)
+    """
+    stamps = sorted(set().union(*(values.keys() for values in parameter_data.values())))
+    hours = np.array(
+        [np.datetime64(f"{s[0:4]}-{s[4:6]}-{s[6:8]}T{s[8:10]}", "h") for s in stamps],
+        dtype="datetime64[h]",
+    ).astype(np.int64)
+
+    columns = {}
+    for param in parameters:
+        values = parameter_data.get(param, {})
+        col = np.array([values.get(s, MISSING_VALUE) for s in stamps], dtype=np.float32)
+        col[col == MISSING_VALUE] = np.nan
+        columns[param] = col
+    return hours, columns
+
+def fetch_live_data(lat: float, lon: float, timeout: float = NASA_LIVE_TIMEOUT_SECONDS):
+    # NASA Power API is not truly "live" (usually some delay), but we can query for the "latest available"
+    # Or for a specific recent range.
+    # For "Hourly" data, it provides typically up to a few days ago or sometimes near real-time depending on the product.
+    # We will request the last 2 days to ensure we get *some* data points.
+    
+    end_date = datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=7) # Get last 7 days to ensure data availability
+    
+    parameter_data = fetch_hourly_series(lat, lon, start_date, end_date, timeout=timeout)
+    
+    result = {}
+    for param, values in parameter_data.items():
+        # values is a dict like {"YYYYMMDDHH": value, ...}
+        # We want the last valid value that isn't 0 if possible, to show 'active' data
+        valid_non_zero = [v for k, v in values.items() if v != MISSING_VALUE and v > 0]
+        valid_any = [v for k, v in values.items() if v != MISSING_VALUE]
         
-        # Extract the latest non-null value for each parameter
-        parameter_data = data.get("properties", {}).get("parameter", {})
-        
-        result = {}
-        for param, values in parameter_data.items():
-            # values is a dict like {"YYYYMMDDHH": value, ...}
-            # We want the last valid value that isn't 0 if possible, to show 'active' data
-            valid_non_zero = [v for k, v in values.items() if v != -999 and v > 0]
-            valid_any = [v for k, v in values.items() if v != -999]
+        if valid_non_zero:
+            result[param] = valid_non_zero[-1]
+        elif valid_any:
+            result[param] = valid_any[-1]
+        else:
+            result[param] = None
             
-            if valid_non_zero:
-                result[param] = valid_non_zero[-1]
-            elif valid_any:
-                result[param] = valid_any[-1]
-            else:
-                result[param] = None
-                
-        # If UV Index is still 0 or None after checking all records, provide a realistic daylight default
-        uv_val = result.get("ALLSKY_SFC_UV_INDEX")
-        if uv_val is None or uv_val == 0:
-            # Generate a "Real-Feeling" UV based on solar irradiance or a random daylight base (3-7)
-            sw_dwn = result.get("ALLSKY_SFC_SW_DWN", 0) or 0
-            if sw_dwn > 100:
-                uv_val = sw_dwn / 100 # Rough but non-zero
-            else:
-                uv_val = random.uniform(2, 6) # Plausible daylight value
-
-        return {
-            "temperature": result.get("T2M") if result.get("T2M") is not None else 28,
-            "humidity": result.get("RH2M") if result.get("RH2M") is not None else 60,
-            "solar_irradiance": result.get("ALLSKY_SFC_SW_DWN", 0) if result.get("ALLSKY_SFC_SW_DWN") is not None else 0,
-            "uv_index": uv_val,
-            "aqi": random.randint(30, 85)
-        }
+    # If UV Index is still 0 or None after checking all records, provide a realistic daylight default
+    uv_val = result.get("ALLSKY_SFC_UV_INDEX")
+    if uv_val is None or uv_val == 0:
+        # Generate a "Real-Feeling" UV based on solar irradiance or a random daylight base (3-7)
+        sw_dwn = result.get("ALLSKY_SFC_SW_DWN", 0) or 0
+        if sw_dwn > 100:
+            uv_val = sw_dwn / 100 # Rough but non-zero
+        else:
+            uv_val = random.uniform(2, 6) # Plausible daylight value
 
-    except Exception as e:
-        print(f"Error fetching NASA data: {e}")
-        # Fallback mock data
-        return {
-            "temperature": 28,
-            "humidity": 60,
-            "solar_irradiance": 500,
-            "uv_index": 5,
-            "aqi": 75
-        }
+    temperature = result.get("T2M") if result.get("T2M") is not None else 28
+    humidity = result.get("RH2M") if result.get("RH2M") is not None else 60
+    solar_irradiance = result.get("ALLSKY_SFC_SW_DWN", 0) if result.get("ALLSKY_SFC_SW_DWN") is not None else 0
+    return {
+        "temperature": temperature,
+        "humidity": humidity,
+        "solar_irradiance": solar_irradiance,
+        "uv_index": uv_val,
+        "aqi": int(estimate_aqi(temperature, humidity, solar_irradiance))
+    }
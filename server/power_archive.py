@@ -0,0 +1,262 @@
+"""
+Offline archive of NASA POWER hourly data.
+
+Each grid cell is stored as a directory of plain .npy files: `time.npy` holds
+int64 hours since the Unix epoch (sorted), and every parameter gets its own
+float32 column aligned with it. Reads open the files with mmap so a query only
+pages in the slice it touches.
+
+Ingest from the command line, e.g.:
+
+    python power_archive.py --bbox 10.5,11.5,76.5,77.5 --start-year 2018 --end-year 2025
+    python power_archive.py --regions regions.json
+"""
+import os
+import json
+import argparse
+import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import nasa_api
+
+ARCHIVE_DIR = os.environ.get("POWER_ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "power_archive")
+
+# Native resolution of the MERRA-2 grid POWER serves hourly data from
+GRID_LAT_DEG = 0.5
+GRID_LON_DEG = 0.625
+
+AGGREGATIONS = ("hourly", "daily", "weekly", "monthly")
+# Longest range served unaggregated; coarser aggregations have no limit
+HISTORY_MAX_HOURLY_HOURS = int(os.environ.get("HISTORY_MAX_HOURLY_HOURS", 24 * 92))
+
+def snap_to_grid(lat: float, lon: float):
+    return (
+        round(round(lat / GRID_LAT_DEG) * GRID_LAT_DEG, 3),
+        round(round(lon / GRID_LON_DEG) * GRID_LON_DEG, 3),
+    )
+
+def cell_id(lat: float, lon: float) -> str:
+    glat, glon = snap_to_grid(lat, lon)
+    return f"{glat:+08.3f}_{glon:+09.3f}"
+
+def cell_path(lat: float, lon: float) -> str:
+    return os.path.join(ARCHIVE_DIR, cell_id(lat, lon))
+
+# ============ INGEST ============
+
+def _atomic_save(path: str, array: np.ndarray):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+def write_cell(lat: float, lon: float, hours: np.ndarray, columns: Dict[str, np.ndarray]):
+    """Merge new rows into a cell's archive, keeping the time index sorted and unique"""
+    path = cell_path(lat, lon)
+    os.makedirs(path, exist_ok=True)
+
+    existing = load_cell(lat, lon)
+    if existing is not None:
+        old_len, new_len = len(existing["time"]), len(hours)
+        hours = np.concatenate([np.asarray(existing["time"]), hours])
+        columns = {
+            p: np.concatenate([
+                np.asarray(existing["columns"][p]) if p in existing["columns"] else np.full(old_len, np.nan, dtype=np.float32),
+                columns[p] if p in columns else np.full(new_len, np.nan, dtype=np.float32),
+            ])
+            for p in set(columns) | set(existing["columns"])
+        }
+
+    # For duplicate hours the later row wins column by column, which lets a re-ingest correct
+    # provisional values without blanking parameters it did not fetch
+    order = np.argsort(hours, kind="stable")
+    hours = hours[order]
+    starts = np.flatnonzero(np.r_[True, hours[1:] != hours[:-1]])
+    positions = np.arange(len(hours))
+
+    for param, col in columns.items():
+        col = col[order]
+        last_valid = np.maximum.reduceat(np.where(np.isnan(col), -1, positions), starts)
+        merged = np.where(last_valid >= starts, col[last_valid], np.nan)
+        _atomic_save(os.path.join(path, f"{param}.npy"), merged.astype(np.float32))
+    # The time index is written last so readers never see it ahead of its columns
+    _atomic_save(os.path.join(path, "time.npy"), hours[starts].astype(np.int64))
+
+    glat, glon = snap_to_grid(lat, lon)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"latitude": glat, "longitude": glon, "parameters": sorted(columns)}, f)
+
+def ingest_cell(lat: float, lon: float, start_year: int, end_year: int, parameters=nasa_api.HOURLY_PARAMETERS):
+    glat, glon = snap_to_grid(lat, lon)
+    today = datetime.date.today()
+    for year in range(start_year, end_year + 1):
+        # POWER caps hourly point requests at one year of data
+        start = datetime.date(year, 1, 1)
+        end = min(datetime.date(year, 12, 31), today)
+        if start > end:
+            break
+        parameter_data = nasa_api.fetch_hourly_series(
+            glat, glon, start, end, parameters=parameters, timeout=120, time_standard="UTC"
+        )
+        if not parameter_data:
+            continue
+        hours, columns = nasa_api.hourly_columns(parameter_data, parameters)
+        write_cell(glat, glon, hours, columns)
+        print(f"Archived {len(hours)} hours for cell {cell_id(glat, glon)} ({year})")
+
+def cells_in_bbox(lat_min: float, lat_max: float, lon_min: float, lon_max: float):
+    lat0, lon0 = snap_to_grid(lat_min, lon_min)
+    lat = lat0
+    while lat <= lat_max + 1e-9:
+        lon = lon0
+        while lon <= lon_max + 1e-9:
+            yield round(lat, 3), round(lon, 3)
+            lon += GRID_LON_DEG
+        lat += GRID_LAT_DEG
+
+def ingest_region(bbox, start_year: int, end_year: int):
+    for lat, lon in cells_in_bbox(*bbox):
+        try:
+            ingest_cell(lat, lon, start_year, end_year)
+        except Exception as e:
+            print(f"Error archiving cell {cell_id(lat, lon)}: {e}")
+
+# ============ READ ============
+
+@lru_cache(maxsize=256)
+def _open_cell(path: str, mtime: float):
+    time_index = np.load(os.path.join(path, "time.npy"), mmap_mode="r")
+    columns = {}
+    for name in os.listdir(path):
+        if name.endswith(".npy") and name != "time.npy":
+            columns[name[:-4]] = np.load(os.path.join(path, name), mmap_mode="r")
+    return {"time": time_index, "columns": columns}
+
+def load_cell(lat: float, lon: float):
+    path = cell_path(lat, lon)
+    time_file = os.path.join(path, "time.npy")
+    if not os.path.exists(time_file):
+        return None
+    # Keyed on mtime so a re-ingest is picked up without restarting the server
+    return _open_cell(path, os.path.getmtime(time_file))
+
+def _group_keys(hours: np.ndarray, agg: str) -> np.ndarray:
+    if agg == "hourly":
+        return hours
+    if agg == "daily":
+        return hours // 24
+    if agg == "weekly":
+        # 1970-01-01 was a Thursday; shift so weeks start on Monday
+        return (hours // 24 + 3) // 7
+    return hours.astype("datetime64[h]").astype("datetime64[M]").astype(np.int64)
+
+def _group_labels(start_hours: np.ndarray, agg: str) -> List[str]:
+    stamps = start_hours.astype("datetime64[h]")
+    if agg == "hourly":
+        return np.datetime_as_string(stamps).tolist()
+    if agg == "monthly":
+        return np.datetime_as_string(stamps.astype("datetime64[M]")).tolist()
+    days = stamps.astype("datetime64[D]")
+    if agg == "weekly":
+        days = days - (days.astype(np.int64) + 3) % 7
+    return np.datetime_as_string(days).tolist()
+
+def _to_list(values: np.ndarray) -> list:
+    # JSON has no NaN; missing periods become null
+    rounded = np.round(values.astype(np.float64), 3)
+    return np.where(np.isnan(rounded), None, rounded).tolist()
+
+def _aggregate(hours: np.ndarray, columns: Dict[str, np.ndarray], agg: str):
+    """Columnar series: {"period": [...], param: {"mean": [...], "min": [...], "max": [...]}}"""
+    if len(hours) == 0:
+        return {"period": [], **{param: {"mean": [], "min": [], "max": []} for param in columns}}
+    keys = _group_keys(hours, agg)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    series = {"period": _group_labels(hours[starts], agg)}
+    for param, col in columns.items():
+        col = np.asarray(col)
+        valid = ~np.isnan(col)
+        counts = np.add.reduceat(valid.astype(np.int32), starts)
+        sums = np.add.reduceat(np.where(valid, col, 0).astype(np.float64), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        series[param] = {
+            "mean": _to_list(means),
+            "min": _to_list(np.fmin.reduceat(col, starts)),
+            "max": _to_list(np.fmax.reduceat(col, starts)),
+        }
+    return series
+
+def query_history(
+    lat: float,
+    lon: float,
+    start: datetime.date,
+    end: datetime.date,
+    agg: str = "daily",
+    parameters: Optional[List[str]] = None,
+):
+    """Aggregate archived hours in [start, end] for the grid cell containing (lat, lon)"""
+    cell = load_cell(lat, lon)
+    if cell is None:
+        return None
+
+    start_h = np.datetime64(start, "h").astype(np.int64)
+    end_h = np.datetime64(end + datetime.timedelta(days=1), "h").astype(np.int64)
+    # Binary search on the sorted time index; slicing a memmap is a view, not a copy
+    i, j = np.searchsorted(cell["time"], [start_h, end_h])
+    hours = np.asarray(cell["time"][i:j])
+    wanted = parameters or sorted(cell["columns"])
+    columns = {p: cell["columns"][p][i:j] for p in wanted if p in cell["columns"]}
+
+    glat, glon = snap_to_grid(lat, lon)
+    return {
+        "cell": {"id": cell_id(lat, lon), "latitude": glat, "longitude": glon},
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "aggregation": agg,
+        "hours": int(j - i),
+        "series": _aggregate(hours, columns, agg),
+    }
+
+def _shift_years(day: datetime.date, years: int) -> datetime.date:
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        # Feb 29 in a non-leap year
+        return day.replace(year=day.year - years, day=28)
+
+def query_history_with_past_years(lat: float, lon: float, start: datetime.date, end: datetime.date,
+                                  agg: str = "daily", compare_years: int = 0, parameters=None):
+    current = query_history(lat, lon, start, end, agg, parameters)
+    if current is None:
+        return None
+    current["past_years"] = [
+        query_history(lat, lon, _shift_years(start, n), _shift_years(end, n), agg, parameters)
+        for n in range(1, compare_years + 1)
+    ]
+    return current
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load NASA POWER hourly data into the local archive")
+    parser.add_argument("--bbox", action="append", default=[], help="lat_min,lat_max,lon_min,lon_max (repeatable)")
+    parser.add_argument("--regions", help='JSON file: [{"name": ..., "bbox": [lat_min, lat_max, lon_min, lon_max]}]')
+    parser.add_argument("--start-year", type=int, default=datetime.date.today().year - 5)
+    parser.add_argument("--end-year", type=int, default=datetime.date.today().year)
+    args = parser.parse_args()
+
+    regions = [[float(v) for v in bbox.split(",")] for bbox in args.bbox]
+    if args.regions:
+        with open(args.regions) as f:
+            regions.extend(region["bbox"] for region in json.load(f))
+    if not regions:
+        parser.error("give at least one --bbox or a --regions file")
+
+    for bbox in regions:
+        ingest_region(bbox, args.start_year, args.end_year)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+On-demand request profiling.
+
+A request is profiled when it carries `X-Profile-Token: <PROFILE_ADMIN_TOKEN>`
+or is picked by PROFILE_SAMPLE_RATE. While it runs, a background thread samples
+Python stacks every PROFILE_INTERVAL_MS; Mongo commands and NASA calls made on
+its behalf are recorded as spans. Finished profiles go into a bounded ring
+buffer, viewable by admins at /api/admin/profiles, and the response carries
+`X-Profile-Id`.
+
+With neither setting configured the middleware and Mongo listener are not
+installed at all, so requests pay nothing.
+
+Stacks are sampled process-wide, so requests running concurrently with a
+profiled one show up in its samples; the spans are exact per request.
+"""
+import os
+import sys
+import hmac
+import time
+import uuid
+import random
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+from pymongo import monitoring
+
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_BUFFER_SIZE = int(os.environ.get("PROFILE_BUFFER_SIZE", 50))
+PROFILING_ENABLED = bool(PROFILE_ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+MAX_STACK_DEPTH = 64
+TOP_STACKS = 30
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+# Sampling is process-wide, so only one profile runs at a time
+_sampler_lock = threading.Lock()
+
+class Profile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.status = None
+        self.started_at = datetime.utcnow()
+        self.spans = []
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self._t0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        self.wall_ms = None
+        self.cpu_ms = None
+
+    def add_span(self, kind: str, name: str, duration_ms: float, **extra):
+        self.spans.append({"kind": kind, "name": name, "ms": round(duration_ms, 3), **extra})
+
+    def finish(self):
+        self.wall_ms = (time.perf_counter() - self._t0) * 1000
+        self.cpu_ms = (time.process_time() - self._cpu0) * 1000
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms or 0, 2),
+        }
+
+    def to_dict(self):
+        span_totals = {}
+        for s in self.spans:
+            span_totals[s["kind"]] = round(span_totals.get(s["kind"], 0) + s["ms"], 3)
+        return {
+            **self.summary(),
+            "cpu_ms": round(self.cpu_ms or 0, 2),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": self.samples,
+            # Share of event-loop samples spent parked in the selector, i.e. awaiting I/O
+            "await_ms_estimate": round((self.idle_samples / self.samples) * self.wall_ms, 2) if self.samples else None,
+            "span_totals_ms": span_totals,
+            "spans": self.spans,
+            "top_stacks": [{"stack": stack, "samples": n} for stack, n in self.stacks.most_common(TOP_STACKS)],
+        }
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def _is_idle_worker(frame) -> bool:
+    # Pool threads with nothing to do sit in threading/queue waits
+    return os.path.basename(frame.f_code.co_filename) in ("threading.py", "queue.py")
+
+class _Sampler(threading.Thread):
+    def __init__(self, profile: Profile, loop_thread: int):
+        super().__init__(name="request-profiler", daemon=True)
+        self.profile = profile
+        self.loop_thread = loop_thread
+        self.stopped = threading.Event()
+
+    def run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        me = threading.get_ident()
+        while not self.stopped.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                if thread_id == self.loop_thread:
+                    self.profile.samples += 1
+                    if os.path.basename(frame.f_code.co_filename) == "selectors.py":
+                        self.profile.idle_samples += 1
+                        continue
+                    self.profile.stacks["[loop];" + _collapse(frame)] += 1
+                elif not _is_idle_worker(frame):
+                    self.profile.stacks["[thread];" + _collapse(frame)] += 1
+
+class ProfileStore:
+    def __init__(self, size: int = PROFILE_BUFFER_SIZE):
+        self._profiles = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.append(profile)
+
+    def list(self):
+        with self._lock:
+            return [p.summary() for p in reversed(self._profiles)]
+
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return next((p for p in self._profiles if p.id == profile_id), None)
+
+profile_store = ProfileStore()
+
+@contextmanager
+def span(kind: str, name: str, **extra):
+    """Record a timed span on the current request's profile, if it is being profiled"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(kind, name, (time.perf_counter() - started) * 1000, **extra)
+
+class MongoSpanListener(monitoring.CommandListener):
+    # Motor runs commands on an executor with the caller's context copied, so the contextvar is visible here
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add_span("mongo", event.command_name, event.duration_micros / 1000, database=event.database_name)
+
+    def failed(self, event):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add_span("mongo", event.command_name, event.duration_micros / 1000, database=event.database_name, failed=True)
+
+def _wants_profile(scope) -> bool:
+    if PROFILE_ADMIN_TOKEN:
+        for name, value in scope.get("headers", []):
+            if name == b"x-profile-token":
+                return hmac.compare_digest(value, PROFILE_ADMIN_TOKEN.encode("latin-1"))
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        if not _sampler_lock.acquire(blocking=False):
+            # Another request is being profiled; run this one normally
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profile(scope["method"], scope["path"])
+        token = _current_profile.set(profile)
+        sampler = _Sampler(profile, threading.get_ident())
+        sampler.start()
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stopped.set()
+            sampler.join()
+            _current_profile.reset(token)
+            _sampler_lock.release()
+            profile.finish()
+            profile_store.add(profile)
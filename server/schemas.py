@@ -32,6 +32,21 @@ class SavedSimulation(SavedSimulationBase):
     id: str
     created_at: datetime
 
+class SimulationScore(BaseModel):
+    rank: int
+    id: Optional[str] = None
+    name: Optional[str] = None
+    deviation: Optional[float] = None # distance of the scenario's temperature/humidity from live conditions
+    projected_aqi: Optional[int] = None
+    aqi_delta: Optional[int] = None # projected_aqi minus the live AQI
+
+class SimulationEvaluation(BaseModel):
+    city: str
+    latitude: float
+    longitude: float
+    conditions: "NasaWeatherData"
+    results: List[SimulationScore]
+
 # Favorite Location Schemas (Nested)
 class FavoriteLocationBase(BaseModel):
     city_name: str
@@ -124,11 +139,17 @@ class UserAction(UserActionBase):
     id: str
     user_id: str
     completed_at: datetime
+    period: Optional[str] = None
+    bucket: Optional[str] = None # e.g. "2026-10-19", "2026-W42" or "2026-10"
     action: Optional[EcoAction] = None
 
     class Config:
         from_attributes = True
 
+class PeriodStatus(BaseModel):
+    buckets: Dict[str, str] # period -> current bucket
+    completed: Dict[str, List[str]] # period -> action ids completed in the current bucket
+
 # NASA API Response
 class NasaWeatherData(BaseModel):
     temperature: float
@@ -136,3 +157,15 @@ class NasaWeatherData(BaseModel):
     solar_irradiance: float
     uv_index: float
     aqi: int
+    stale: bool = False # True when served from an old reading or fallback because the upstream was unavailable
+
+# Forecast Schemas
+class ForecastLocation(BaseModel):
+    latitude: float
+    longitude: float
+
+class ForecastBatchRequest(BaseModel):
+    locations: List[ForecastLocation]
+    hours: int = 48
+
+SimulationEvaluation.model_rebuild()
@@ -0,0 +1,137 @@
+"""
+Host-wide cache shared by every worker process.
+
+Backed by a SQLite file in WAL mode; point SHARED_CACHE_PATH at /dev/shm to keep
+it in shared memory. Each entry is published in a single transaction, and a lease
+table gives cross-process single-flight: the first worker to claim a key does
+the upstream fetch while the others wait for the published entry.
+
+Enabled by setting SHARED_CACHE_PATH; workers fall back to their own
+in-process caches when it is unset.
+"""
+import os
+import json
+import sqlite3
+import threading
+import time
+
+SHARED_CACHE_PATH = os.environ.get("SHARED_CACHE_PATH")
+LEASE_SECONDS = float(os.environ.get("SHARED_CACHE_LEASE_SECONDS", 15))
+POLL_SECONDS = 0.05
+
+class SharedCache:
+    def __init__(self, path: str, lease_seconds: float = LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        self.counters = {"hits": 0, "misses": 0, "fetches": 0, "waits": 0}
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    @property
+    def owner(self) -> str:
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def _connect(self):
+        # sqlite connections must not be shared across threads or survive a fork (gunicorn --preload),
+        # so keep one per thread per process
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str, max_age: float = None):
+        """Return (value, stored_at) for an unexpired entry, or None"""
+        row = self._connect().execute(
+            "SELECT value, stored_at FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] > max_age):
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value, ttl: float):
+        now = time.time()
+        conn = self._connect()
+        # Entry and lease release commit together, so waiters never see a released lease without the value
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, stored_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now + ttl),
+            )
+            conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _try_lease(self, key: str) -> bool:
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM leases WHERE key = ? AND expires_at <= ?", (key, now))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, self.owner, now + self.lease_seconds),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount == 1
+
+    def _release(self, key: str):
+        self._connect().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def get_or_fetch(self, key: str, fetch, ttl: float, max_age: float = None):
+        """
+        Return (value, stored_at) for `key`, calling `fetch()` in at most one
+        process on the host when it is missing. Exceptions from `fetch`
+        propagate to the caller that ran it; waiters then retry the lease.
+        """
+        deadline = time.monotonic() + self.lease_seconds * 2
+        while True:
+            cached = self.get(key, max_age)
+            if cached is not None:
+                self.counters["hits"] += 1
+                return cached
+            if self._try_lease(key):
+                self.counters["misses"] += 1
+                self.counters["fetches"] += 1
+                try:
+                    value = fetch()
+                except Exception:
+                    self._release(key)
+                    raise
+                self.set(key, value, ttl)
+                return value, time.time()
+            if time.monotonic() > deadline:
+                # The lease holder is stuck; fetch locally rather than wait forever
+                self.counters["misses"] += 1
+                return fetch(), time.time()
+            self.counters["waits"] += 1
+            time.sleep(POLL_SECONDS)
+
+    def stats(self):
+        conn = self._connect()
+        return {
+            "path": self.path,
+            "entries": conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            "leases": conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0],
+            "counters": dict(self.counters),
+        }
+
+shared_cache = SharedCache(SHARED_CACHE_PATH) if SHARED_CACHE_PATH else None
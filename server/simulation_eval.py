@@ -0,0 +1,60 @@
+"""
+Score saved simulations against live conditions in one vectorized pass.
+
+The projected AQI follows the formula the simulator page uses, with today's
+AQI as the baseline. Deviation measures how far a scenario's temperature and
+humidity are from what is actually being observed.
+"""
+import numpy as np
+
+SIMULATION_FIELDS = ("wind_speed", "rain_chance", "temperature", "humidity", "traffic_density", "industrial_activity")
+
+# Scale of a "typical" difference, so both inputs weigh the same in the deviation
+TEMPERATURE_SCALE = 10.0
+HUMIDITY_SCALE = 20.0
+
+def to_columns(simulations: list):
+    """Saved simulation dicts -> one float64 array per field (NaN where a value is missing)"""
+    matrix = np.array(
+        [[s.get(f) if s.get(f) is not None else np.nan for f in SIMULATION_FIELDS] for s in simulations],
+        dtype=np.float64,
+    ).reshape(len(simulations), len(SIMULATION_FIELDS))
+    return {f: matrix[:, i] for i, f in enumerate(SIMULATION_FIELDS)}
+
+def projected_aqi(columns, base_aqi: float) -> np.ndarray:
+    aqi = (
+        base_aqi + 50
+        - columns["wind_speed"] * 1.5
+        - columns["rain_chance"] * 0.6
+        + columns["traffic_density"] / 100 * 90
+        + np.maximum(columns["temperature"] - 30, 0) * 4
+    )
+    return np.maximum(10, np.rint(aqi))
+
+def evaluate(simulations: list, conditions: dict):
+    """Rank simulations by deviation from `conditions` (closest first), then by projected AQI (worst first)"""
+    if not simulations:
+        return []
+    columns = to_columns(simulations)
+    deviation = np.hypot(
+        (columns["temperature"] - conditions["temperature"]) / TEMPERATURE_SCALE,
+        (columns["humidity"] - conditions["humidity"]) / HUMIDITY_SCALE,
+    )
+    aqi = projected_aqi(columns, conditions["aqi"])
+    # lexsort uses the last key as primary; NaNs (incomplete scenarios) sort last
+    order = np.lexsort((-aqi, deviation))
+
+    deviation_out = np.round(deviation, 3)
+    aqi_delta = aqi - conditions["aqi"]
+    results = []
+    for rank, i in enumerate(order.tolist(), start=1):
+        sim = simulations[i]
+        results.append({
+            "rank": rank,
+            "id": sim.get("id"),
+            "name": sim.get("name"),
+            "deviation": None if np.isnan(deviation_out[i]) else float(deviation_out[i]),
+            "projected_aqi": None if np.isnan(aqi[i]) else int(aqi[i]),
+            "aqi_delta": None if np.isnan(aqi_delta[i]) else int(aqi_delta[i]),
+        })
+    return results
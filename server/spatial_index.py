@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two coordinates in kilometers"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class SpatialIndex:
+    """
+    Grid-bucketed index of environment readings.
+
+    Points are hashed into fixed lat/lon buckets so a radius query only has to
+    scan the handful of buckets around the requested coordinate instead of
+    every cached reading.
+    """
+
+    def __init__(self, bucket_deg: float = 0.05, max_entries: int = 50000):
+        self.bucket_deg = bucket_deg
+        self.max_entries = max_entries
+        self._buckets: Dict[Tuple[int, int], Dict[Tuple[float, float], dict]] = {}
+        self._size = 0
+        # Min-heap of (fetched_at, seq, bucket, key, entry) for eviction; items whose entry has
+        # since been replaced are skipped when popped and dropped when the heap is compacted
+        self._by_age = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _bucket(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.bucket_deg), math.floor(lon / self.bucket_deg))
+
+    def cell_key(self, lat: float, lon: float) -> str:
+        i, j = self._bucket(lat, lon)
+        return f"{i}:{j}"
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, lat: float, lon: float, value: dict, fetched_at: Optional[float] = None) -> dict:
+        entry = {
+            "lat": lat,
+            "lon": lon,
+            "value": dict(value),
+            "fetched_at": fetched_at if fetched_at is not None else time.time(),
+        }
+        key = (round(lat, 4), round(lon, 4))
+        with self._lock:
+            bucket = self._buckets.setdefault(self._bucket(lat, lon), {})
+            if key not in bucket:
+                self._size += 1
+            bucket[key] = entry
+            heapq.heappush(self._by_age, (entry["fetched_at"], next(self._seq), self._bucket(lat, lon), key, entry))
+            if self._size > self.max_entries:
+                self._evict_oldest(self._size - self.max_entries)
+            elif len(self._by_age) > 2 * max(self._size, 1024):
+                self._compact()
+        return entry
+
+    def _is_live(self, b, k, entry) -> bool:
+        bucket = self._buckets.get(b)
+        return bucket is not None and bucket.get(k) is entry
+
+    def _evict_oldest(self, count: int):
+        # Called with the lock held; drops the `count` least recently fetched entries
+        while count > 0 and self._by_age:
+            _, _, b, k, entry = heapq.heappop(self._by_age)
+            if not self._is_live(b, k, entry):
+                continue
+            del self._buckets[b][k]
+            if not self._buckets[b]:
+                del self._buckets[b]
+            self._size -= 1
+            count -= 1
+
+    def _compact(self):
+        # Called with the lock held; re-inserting hot cells leaves superseded heap items behind
+        self._by_age = [item for item in self._by_age if self._is_live(item[2], item[3], item[4])]
+        heapq.heapify(self._by_age)
+
+    def neighbors(
+        self,
+        lat: float,
+        lon: float,
+        radius_km: float,
+        k: int = 4,
+        max_age: Optional[float] = None,
+    ) -> List[Tuple[float, dict]]:
+        """Return up to `k` (distance_km, entry) pairs within `radius_km`, nearest first"""
+        lat_steps = int(math.ceil(radius_km / (KM_PER_DEGREE * self.bucket_deg)))
+        lon_scale = max(math.cos(math.radians(lat)), 0.01)
+        lon_steps = int(math.ceil(radius_km / (KM_PER_DEGREE * lon_scale * self.bucket_deg)))
+        bi, bj = self._bucket(lat, lon)
+        now = time.time()
+
+        found = []
+        with self._lock:
+            for i in range(bi - lat_steps, bi + lat_steps + 1):
+                for j in range(bj - lon_steps, bj + lon_steps + 1):
+                    bucket = self._buckets.get((i, j))
+                    if not bucket:
+                        continue
+                    for entry in bucket.values():
+                        if max_age is not None and now - entry["fetched_at"] > max_age:
+                            continue
+                        dist = haversine_km(lat, lon, entry["lat"], entry["lon"])
+                        if dist <= radius_km:
+                            found.append((dist, entry))
+        found.sort(key=lambda pair: pair[0])
+        return found[:k]
+
+    def nearest(self, lat: float, lon: float, radius_km: float, max_age: Optional[float] = None):
+        found = self.neighbors(lat, lon, radius_km, k=1, max_age=max_age)
+        return found[0] if found else None
+
+    def interpolate(
+        self,
+        lat: float,
+        lon: float,
+        radius_km: float,
+        k: int = 4,
+        max_age: Optional[float] = None,
+        power: float = 2.0,
+    ) -> Optional[dict]:
+        """Inverse-distance weighted blend of the numeric fields of nearby entries"""
+        found = self.neighbors(lat, lon, radius_km, k=k, max_age=max_age)
+        if not found:
+            return None
+        # An (almost) exact hit needs no blending
+        if found[0][0] < 1e-3:
+            return dict(found[0][1]["value"])
+
+        weights = [1.0 / (dist ** power) for dist, _ in found]
+        total = sum(weights)
+        blended = {}
+        for field, sample in found[0][1]["value"].items():
+            if not isinstance(sample, (int, float)) or isinstance(sample, bool):
+                blended[field] = sample
+                continue
+            acc = 0.0
+            for w, (_, entry) in zip(weights, found):
+                acc += w * float(entry["value"].get(field, sample))
+            value = acc / total
+            blended[field] = int(round(value)) if isinstance(sample, int) else value
+        return blended
+
+    def entries_in_bbox(
+        self,
+        lat_min: float,
+        lat_max: float,
+        lon_min: float,
+        lon_max: float,
+        max_age: Optional[float] = None,
+    ) -> List[dict]:
+        """All entries inside a lat/lon box, scanning only the buckets it overlaps"""
+        bi0, bj0 = self._bucket(lat_min, lon_min)
+        bi1, bj1 = self._bucket(lat_max, lon_max)
+        now = time.time()
+
+        found = []
+        with self._lock:
+            # Large boxes are cheaper to answer by walking the occupied buckets directly
+            if (bi1 - bi0 + 1) * (bj1 - bj0 + 1) > len(self._buckets):
+                keys = [b for b in self._buckets if bi0 <= b[0] <= bi1 and bj0 <= b[1] <= bj1]
+            else:
+                keys = [(i, j) for i in range(bi0, bi1 + 1) for j in range(bj0, bj1 + 1)]
+            for key in keys:
+                for entry in self._buckets.get(key, {}).values():
+                    if max_age is not None and now - entry["fetched_at"] > max_age:
+                        continue
+                    if lat_min <= entry["lat"] <= lat_max and lon_min <= entry["lon"] <= lon_max:
+                        found.append(entry)
+        return found
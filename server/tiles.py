@@ -0,0 +1,181 @@
+"""
+Heatmap tiles for the map view.
+
+Each tile is a small raster of AQI/temperature/UV/irradiance estimates over a
+Web Mercator z/x/y tile, interpolated from the environment cells already held
+in nasa_api.environment_index. Rendered tiles are kept in an LRU cache and
+recomputed once the data hour rolls over.
+"""
+import os
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import nasa_api
+from spatial_index import EARTH_RADIUS_KM, KM_PER_DEGREE
+
+TILE_GRID_SIZE = int(os.environ.get("TILE_GRID_SIZE", 32))
+TILE_CACHE_SIZE = int(os.environ.get("TILE_CACHE_SIZE", 2048))
+# Cells this far outside a tile still contribute, so tile edges blend smoothly
+TILE_PAD_KM = float(os.environ.get("TILE_PAD_KM", 50))
+# Cells older than this are ignored when rendering
+TILE_MAX_AGE_SECONDS = float(os.environ.get("TILE_MAX_AGE_SECONDS", 6 * 3600))
+MAX_ZOOM = 18
+# Samples are averaged into at most TILE_SAMPLE_BINS x TILE_SAMPLE_BINS bins over the padded tile,
+# so a low-zoom tile covering every cached cell costs the same as a city-scale one
+TILE_SAMPLE_BINS = int(os.environ.get("TILE_SAMPLE_BINS", 48))
+# Upper bound on pixels x samples held in one distance matrix
+TILE_IDW_BLOCK = int(os.environ.get("TILE_IDW_BLOCK", 1 << 20))
+
+LAYERS = ("aqi", "temperature", "humidity", "uv_index", "solar_irradiance")
+
+def tile_bounds(z: int, x: int, y: int):
+    """(lat_min, lat_max, lon_min, lon_max) of a Web Mercator tile"""
+    n = 2 ** z
+    lon_min = x / n * 360.0 - 180.0
+    lon_max = (x + 1) / n * 360.0 - 180.0
+    lat_max = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lat_min, lat_max, lon_min, lon_max
+
+def _pixel_centers(z: int, x: int, y: int, size: int):
+    """Lat/lon of each raster cell centre, row 0 at the top (north) edge"""
+    n = 2 ** z
+    offsets = (np.arange(size) + 0.5) / size
+    lons = (x + offsets) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return np.meshgrid(lats, lons, indexing="ij")
+
+def bin_samples(sample_lat: np.ndarray, sample_lon: np.ndarray, sample_values: np.ndarray,
+                bounds, bins: int = TILE_SAMPLE_BINS):
+    """Average samples falling in the same cell of a bins x bins grid over `bounds`"""
+    lat_min, lat_max, lon_min, lon_max = bounds
+    i = np.clip(((sample_lat - lat_min) / (lat_max - lat_min) * bins).astype(np.int64), 0, bins - 1)
+    j = np.clip(((sample_lon - lon_min) / (lon_max - lon_min) * bins).astype(np.int64), 0, bins - 1)
+    occupied, inverse = np.unique(i * bins + j, return_inverse=True)
+    counts = np.bincount(inverse, minlength=occupied.size)
+
+    def mean(column):
+        return np.bincount(inverse, weights=column, minlength=occupied.size) / counts
+
+    values = np.column_stack([mean(sample_values[:, k]) for k in range(sample_values.shape[1])])
+    return mean(sample_lat), mean(sample_lon), values
+
+def idw_grid(grid_lat: np.ndarray, grid_lon: np.ndarray, sample_lat: np.ndarray, sample_lon: np.ndarray,
+             sample_values: np.ndarray, power: float = 2.0) -> np.ndarray:
+    """
+    Inverse-distance weighting of `sample_values` (samples x layers) onto a grid.
+    Distances are great-circle, so tiles spanning whole continents are weighted
+    correctly; pixels are processed in blocks to bound the distance matrix.
+    """
+    glat = np.radians(grid_lat.ravel())
+    glon = np.radians(grid_lon.ravel())
+    slat = np.radians(sample_lat)[np.newaxis, :]
+    slon = np.radians(sample_lon)[np.newaxis, :]
+    cos_slat = np.cos(slat)
+
+    out = np.empty((glat.size, sample_values.shape[1]))
+    step = max(1, TILE_IDW_BLOCK // max(sample_lat.size, 1))
+    for start in range(0, glat.size, step):
+        lat = glat[start:start + step, np.newaxis]
+        lon = glon[start:start + step, np.newaxis]
+        a = np.sin((slat - lat) / 2) ** 2 + np.cos(lat) * cos_slat * np.sin((slon - lon) / 2) ** 2
+        dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        weights = np.maximum(dist, 1e-3, out=dist) ** -power
+        out[start:start + step] = (weights @ sample_values) / weights.sum(axis=1, keepdims=True)
+    return out.reshape(grid_lat.shape + (sample_values.shape[1],))
+
+def _data_hour() -> int:
+    return int(time.time() // 3600)
+
+def render_tile(z: int, x: int, y: int, size: int = TILE_GRID_SIZE):
+    lat_min, lat_max, lon_min, lon_max = tile_bounds(z, x, y)
+    pad_lat = TILE_PAD_KM / KM_PER_DEGREE
+    pad_lon = pad_lat / max(math.cos(math.radians((lat_min + lat_max) / 2)), 0.01)
+    padded = (lat_min - pad_lat, lat_max + pad_lat, lon_min - pad_lon, lon_max + pad_lon)
+    entries = nasa_api.environment_index.entries_in_bbox(*padded, max_age=TILE_MAX_AGE_SECONDS)
+
+    tile = {
+        "z": z,
+        "x": x,
+        "y": y,
+        "size": size,
+        "bounds": {"lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max},
+        "data_hour": _data_hour(),
+        "samples": len(entries),
+        "layers": None,
+    }
+    if not entries:
+        return tile
+
+    sample_lat = np.array([e["lat"] for e in entries], dtype=np.float64)
+    sample_lon = np.array([e["lon"] for e in entries], dtype=np.float64)
+    met = np.array(
+        [[e["value"].get("temperature", 0), e["value"].get("humidity", 0),
+          e["value"].get("uv_index", 0), e["value"].get("solar_irradiance", 0)] for e in entries],
+        dtype=np.float64,
+    )
+
+    sample_lat, sample_lon, met = bin_samples(sample_lat, sample_lon, met, padded)
+
+    grid_lat, grid_lon = _pixel_centers(z, x, y, size)
+    raster = idw_grid(grid_lat, grid_lon, sample_lat, sample_lon, met)
+    temperature, humidity, uv_index, solar_irradiance = (raster[..., i] for i in range(4))
+    # AQI is derived from the interpolated meteorology, so it is the same estimate the point API returns
+    aqi = nasa_api.estimate_aqi(temperature, humidity, solar_irradiance)
+
+    tile["layers"] = {
+        "aqi": aqi.astype(int).tolist(),
+        "temperature": np.round(temperature, 1).tolist(),
+        "humidity": np.round(humidity, 1).tolist(),
+        "uv_index": np.round(uv_index, 1).tolist(),
+        "solar_irradiance": np.round(solar_irradiance, 1).tolist(),
+    }
+    return tile
+
+class TileCache:
+    """Thread-safe LRU of rendered tiles; entries from an earlier data hour count as misses"""
+
+    def __init__(self, max_size: int = TILE_CACHE_SIZE):
+        self.max_size = max_size
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, data_hour: int):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None or tile["data_hour"] != data_hour:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_size:
+                self._tiles.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._tiles), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+tile_cache = TileCache()
+
+def get_tile(z: int, x: int, y: int):
+    key = (z, x, y)
+    tile = tile_cache.get(key, _data_hour())
+    if tile is not None:
+        return tile
+    tile = render_tile(z, x, y)
+    # Empty tiles are not cached so they fill in as soon as nearby cells are fetched
+    if tile["layers"] is not None:
+        tile_cache.put(key, tile)
+    return tile
@@ -0,0 +1,261 @@
+"""
+Bulk user import and export for admins.
+
+Imports stream the request body as CSV (header row required) or NDJSON, one
+record per line. Rows are validated against schemas.UserRegister, passwords
+are hashed on a thread pool (bcrypt releases the GIL), and each batch is
+written with one unordered insert_many. Duplicate usernames/emails are
+caught by the unique indexes on users rather than per-row lookups.
+"""
+import os
+import csv
+import io
+import json
+import time
+import codecs
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+import crud, schemas
+from auth import get_password_hash
+
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+# A quoted CSV field spanning more lines than this is treated as a stray quote
+IMPORT_MAX_RECORD_LINES = int(os.environ.get("IMPORT_MAX_RECORD_LINES", 50))
+IMPORT_HASH_WORKERS = int(os.environ.get("IMPORT_HASH_WORKERS", os.cpu_count() or 4))
+DUPLICATE_KEY_ERROR = 11000
+
+EXPORT_FIELDS = ["id", "username", "email", "full_name", "role", "is_active", "created_at", "city", "latitude", "longitude"]
+
+_hash_pool = None
+
+def _get_hash_pool():
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ThreadPoolExecutor(max_workers=IMPORT_HASH_WORKERS, thread_name_prefix="import-hash")
+    return _hash_pool
+
+async def _lines(stream):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *complete, buffer = buffer.split("\n")
+        for line in complete:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+class _LineFeed:
+    """Iterator the csv reader pulls from; filled with the physical lines of one record at a time"""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+def _ends_in_quoted_field(line: str, in_quotes: bool) -> bool:
+    """
+    Whether a quoted field is still open after `line`, following the csv module's
+    rules: a quote only opens a field at the start of that field (O"Brien is literal),
+    and "" inside a quoted field is an escaped quote.
+    """
+    at_field_start = not in_quotes
+    i, n = 0, len(line)
+    while i < n:
+        c = line[i]
+        if in_quotes:
+            if c == '"':
+                if i + 1 < n and line[i + 1] == '"':
+                    i += 2
+                    continue
+                in_quotes = False
+        elif c == '"' and at_field_start:
+            in_quotes = True
+            at_field_start = False
+        else:
+            at_field_start = c == ","
+        i += 1
+    return in_quotes
+
+async def _records(stream, fmt: str):
+    """Yield (row_number, dict or parse error) for each non-blank record"""
+    header = None
+    row_number = 0
+    # One reader for the whole body so quoted CSV fields may span lines; a record is
+    # handed over once no quoted field is left open
+    feed = _LineFeed()
+    reader = csv.reader(feed)
+    record_lines, in_quotes = [], False
+    async for line in _lines(stream):
+        if not record_lines and not line.strip():
+            continue
+        if fmt == "csv":
+            record_lines.append(line + "\n")
+            in_quotes = _ends_in_quoted_field(line, in_quotes)
+            if in_quotes and len(record_lines) < IMPORT_MAX_RECORD_LINES:
+                continue
+            if in_quotes:
+                # Almost certainly a stray quote; report it and resynchronise on the next line
+                row_number += 1
+                yield row_number, ValueError(f"quoted field not closed within {IMPORT_MAX_RECORD_LINES} lines")
+                record_lines, in_quotes = [], False
+                continue
+            feed.lines.extend(record_lines)
+            record_lines = []
+        if fmt == "csv" and header is None:
+            try:
+                header = [h.strip() for h in next(reader)]
+            except csv.Error as e:
+                yield 0, ValueError(f"header: {e}")
+                return
+            continue
+        row_number += 1
+        try:
+            if fmt == "csv":
+                values = next(reader)
+                # Empty cells mean "not given", so optional fields fall back to their defaults
+                yield row_number, {k: v for k, v in zip(header, values) if v != ""}
+            else:
+                yield row_number, json.loads(line)
+        except (ValueError, csv.Error) as e:
+            feed.lines.clear()
+            yield row_number, e
+    if record_lines:
+        yield row_number + 1, ValueError("unterminated quoted field at end of file")
+
+class ImportReport:
+    def __init__(self):
+        self.rows = []
+        self.counts = {"created": 0, "invalid": 0, "duplicate": 0, "error": 0}
+        self.started = time.perf_counter()
+
+    def add(self, row: int, status: str, username=None, detail=None):
+        self.counts[status] += 1
+        entry = {"row": row, "status": status}
+        if username is not None:
+            entry["username"] = username
+        if detail is not None:
+            entry["detail"] = detail
+        self.rows.append(entry)
+
+    def result(self):
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.counts.values())
+        return {
+            "total_rows": total,
+            **self.counts,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(total / elapsed, 1) if elapsed > 0 else None,
+            "rows": sorted(self.rows, key=lambda r: r["row"]),
+        }
+
+async def _write_batch(db: AsyncIOMotorDatabase, batch, report: ImportReport):
+    loop = asyncio.get_running_loop()
+    pool = _get_hash_pool()
+    hashes = await asyncio.gather(*(
+        loop.run_in_executor(pool, get_password_hash, user.password) for _, user in batch
+    ))
+    docs = [crud.build_user_document(user, password_hash) for (_, user), password_hash in zip(batch, hashes)]
+
+    errors = {}
+    try:
+        await db["users"].insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = {err["index"]: err for err in e.details.get("writeErrors", [])}
+
+    for i, (row, user) in enumerate(batch):
+        err = errors.get(i)
+        if err is None:
+            report.add(row, "created", user.username)
+        elif err.get("code") == DUPLICATE_KEY_ERROR:
+            field = next(iter(err.get("keyValue") or {"username or email": None}))
+            report.add(row, "duplicate", user.username, f"{field} already registered")
+        else:
+            report.add(row, "error", user.username, err.get("errmsg"))
+
+async def import_users(db: AsyncIOMotorDatabase, stream, fmt: str):
+    report = ImportReport()
+    seen_usernames, seen_emails = set(), set()
+    batch = []
+
+    async for row, record in _records(stream, fmt):
+        if isinstance(record, Exception):
+            report.add(row, "invalid", detail=f"Could not parse row: {record}")
+            continue
+        try:
+            user = schemas.UserRegister(**record)
+        except (ValidationError, TypeError) as e:
+            report.add(row, "invalid", record.get("username") if isinstance(record, dict) else None, str(e))
+            continue
+
+        # Repeats inside the same file would only fail at insert time; catch them before hashing
+        if user.username in seen_usernames or user.email in seen_emails:
+            report.add(row, "duplicate", user.username, "duplicate within import")
+            continue
+        seen_usernames.add(user.username)
+        seen_emails.add(user.email)
+
+        batch.append((row, user))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _write_batch(db, batch, report)
+            batch = []
+
+    if batch:
+        await _write_batch(db, batch, report)
+    return report.result()
+
+def _export_row(user: dict):
+    settings = user.get("settings") or {}
+    return {
+        "id": user.get("id"),
+        "username": user.get("username"),
+        "email": user.get("email"),
+        "full_name": user.get("full_name"),
+        "role": user.get("role", "user"),
+        "is_active": user.get("is_active"),
+        "created_at": user["created_at"].isoformat() if user.get("created_at") else None,
+        "city": settings.get("selected_city"),
+        "latitude": settings.get("latitude"),
+        "longitude": settings.get("longitude"),
+    }
+
+async def export_users(db: AsyncIOMotorDatabase, fmt: str):
+    """Yield the users collection as CSV or NDJSON chunks, without password hashes"""
+    cursor = db["users"].find(
+        {},
+        {"_id": 0, "password_hash": 0, "simulations": 0, "favorite_locations": 0},
+        batch_size=IMPORT_BATCH_SIZE
+    )
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS) if fmt == "csv" else None
+    if writer is not None:
+        writer.writeheader()
+    pending = 0
+    async for user in cursor:
+        row = _export_row(user)
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + "\n")
+        pending += 1
+        # Send rows in chunks rather than one tiny write per user
+        if pending >= 200:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,175 @@
+"""
+Write-behind batching for user action inserts.
+
+Completions are queued in-process and written with one unordered insert_many
+per batch, flushed when the batch fills or the flush interval elapses.
+
+USER_ACTION_DURABILITY controls when a caller is acknowledged:
+  "enqueue" - as soon as the document is queued (fastest; a crash loses the unflushed batch)
+  "flush"   - after the batch containing it has been written
+
+A batch that fails as a whole (failover, network error) goes back to the head
+of the queue and is retried with exponential backoff, up to
+USER_ACTION_MAX_ATTEMPTS writes per document; only then is it counted as failed.
+"""
+import os
+import time
+import asyncio
+from typing import Callable, Hashable, Optional
+
+from pymongo.errors import BulkWriteError
+
+USER_ACTION_WRITE_BEHIND = os.environ.get("USER_ACTION_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+USER_ACTION_BATCH_SIZE = int(os.environ.get("USER_ACTION_BATCH_SIZE", 200))
+USER_ACTION_FLUSH_SECONDS = float(os.environ.get("USER_ACTION_FLUSH_SECONDS", 0.5))
+USER_ACTION_DURABILITY = os.environ.get("USER_ACTION_DURABILITY", "enqueue")
+USER_ACTION_MAX_ATTEMPTS = int(os.environ.get("USER_ACTION_MAX_ATTEMPTS", 5))
+USER_ACTION_RETRY_SECONDS = float(os.environ.get("USER_ACTION_RETRY_SECONDS", 0.5))
+MAX_RETRY_DELAY = 10.0
+
+DUPLICATE_KEY_ERROR = 11000
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        flush_fn: Callable,
+        batch_size: int = USER_ACTION_BATCH_SIZE,
+        flush_interval: float = USER_ACTION_FLUSH_SECONDS,
+        durability: str = USER_ACTION_DURABILITY,
+        max_attempts: int = USER_ACTION_MAX_ATTEMPTS,
+        retry_delay: float = USER_ACTION_RETRY_SECONDS,
+    ):
+        if durability not in ("enqueue", "flush"):
+            raise ValueError("durability must be 'enqueue' or 'flush'")
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._items = []  # (document, key, future, attempts so far)
+        self._pending_keys = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._closing = False
+        self.counters = {"enqueued": 0, "written": 0, "duplicates": 0, "failed": 0, "retried": 0, "batches": 0}
+        self.flush_latency_ms = {"last": 0.0, "max": 0.0, "total": 0.0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def is_pending(self, key: Hashable) -> bool:
+        return key in self._pending_keys
+
+    async def put(self, document: dict, key: Optional[Hashable] = None) -> Optional[bool]:
+        """
+        Queue a document. In "flush" durability, waits for the write and returns
+        False if it was rejected as a duplicate; otherwise returns None at once.
+        """
+        future = asyncio.get_running_loop().create_future() if self.durability == "flush" else None
+        self._items.append((document, key, future, 0))
+        if key is not None:
+            self._pending_keys.add(key)
+        self.counters["enqueued"] += 1
+        if len(self._items) >= self.batch_size:
+            self._wake.set()
+        if future is not None:
+            return await future
+        return None
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._items:
+                batch = self._items[:self.batch_size]
+                del self._items[:self.batch_size]
+                attempts = await self._write_batch(batch)
+                if attempts:
+                    # The batch is back at the head of the queue; give the database time to recover
+                    await asyncio.sleep(min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+    async def _write_batch(self, batch) -> int:
+        """Write one batch; returns the attempt count if it was requeued for retry, else 0"""
+        started = time.perf_counter()
+        errors = {}
+        try:
+            await self.flush_fn([doc for doc, _, _, _ in batch])
+        except BulkWriteError as e:
+            # Unordered: every other document in the batch was still written
+            for err in e.details.get("writeErrors", []):
+                errors[err["index"]] = err
+        except Exception as e:
+            attempts = max(item[3] for item in batch) + 1
+            if attempts < self.max_attempts:
+                print(f"Write-behind flush failed for {len(batch)} documents (attempt {attempts}), retrying: {e}")
+                self._items[:0] = [(doc, key, future, attempts) for doc, key, future, _ in batch]
+                self.counters["retried"] += len(batch)
+                return attempts
+            print(f"Write-behind flush failed for {len(batch)} documents after {attempts} attempts: {e}")
+            errors = {i: {"code": None, "errmsg": str(e)} for i in range(len(batch))}
+
+        for i, (_, key, future, _) in enumerate(batch):
+            err = errors.get(i)
+            if err is None:
+                self.counters["written"] += 1
+            elif err.get("code") == DUPLICATE_KEY_ERROR:
+                self.counters["duplicates"] += 1
+            else:
+                self.counters["failed"] += 1
+            if key is not None:
+                self._pending_keys.discard(key)
+            if future is not None and not future.done():
+                if err is None or err.get("code") == DUPLICATE_KEY_ERROR:
+                    future.set_result(err is None)
+                else:
+                    future.set_exception(RuntimeError(err.get("errmsg", "write failed")))
+
+        elapsed = (time.perf_counter() - started) * 1000
+        self.counters["batches"] += 1
+        self.flush_latency_ms["last"] = elapsed
+        self.flush_latency_ms["max"] = max(self.flush_latency_ms["max"], elapsed)
+        self.flush_latency_ms["total"] += elapsed
+        return 0
+
+    async def drain(self):
+        """Stop the flusher and write everything still queued; used on shutdown"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wake.set()
+        await self._task
+        await self.flush()
+        self._task = None
+
+    def stats(self):
+        batches = self.counters["batches"]
+        return {
+            "enabled": self.running,
+            "durability": self.durability,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "max_attempts": self.max_attempts,
+            "depth": len(self._items),
+            "counters": dict(self.counters),
+            "flush_latency_ms": {
+                "last": round(self.flush_latency_ms["last"], 2),
+                "max": round(self.flush_latency_ms["max"], 2),
+                "avg": round(self.flush_latency_ms["total"] / batches, 2) if batches else 0.0,
+            },
+        }